@@ -1,3 +1,4 @@
+import sys
 import tkinter
 import customtkinter
 from PIL import Image, ImageTk
@@ -5,21 +6,40 @@ import cv2
 import numpy as np         
 import pyrealsense2 as rs
 
+from capture import CaptureThread, FrameCounter, FrameRing, RingWorker, SourceGrabber
+from frame_source import LiveSource, RecordedSource
+from colorize import DepthColorizer
+from display import FrameDisplay
+from utils import LordeTracker
+
 customtkinter.set_appearance_mode("System")  # Modes: "System" (standard), "Dark", "Light"
 customtkinter.set_default_color_theme("blue")  # Themes: "blue" (standard), "green", "dark-blue"
 
 class App(customtkinter.CTk):
-    def __init__(self):
+    def __init__(self, source=None):  # source: frame_source to read from, the RealSense camera by default
         super().__init__()
 
         ####### Realsense setup ##############################################################################################
-        self.pipeline = rs.pipeline()
-        self.config = rs.config()
-        self.config.enable_stream(rs.stream.depth, 640, 480, rs.format.z16, 30)
-        self.config.enable_stream(rs.stream.color, 1280, 720, rs.format.bgr8, 30)
-
-        self.profile = self.pipeline.start(self.config)
-        self.colorizer = rs.colorizer()
+        if source is None:
+            self.config = rs.config()
+            self.config.enable_stream(rs.stream.depth, 640, 480, rs.format.z16, 30)
+            self.config.enable_stream(rs.stream.color, 1280, 720, rs.format.bgr8, 30)
+
+            source = LiveSource(self.config).start()  # depth aligned to color
+        self.source = source
+        self.colorizer = DepthColorizer()
+
+        # Capture runs on its own thread and fills a ring of the newest frames, the UI only renders the latest
+        self.grab = SourceGrabber(source)
+        self.frame_ring = FrameRing(capacity=4)
+        self.capture = None
+        self.frame_counter = FrameCounter()
+        self.frame = None  # newest Frame shown (index, timestamp, color, depth)
+        self.depth_colormap = None  # colorizer output buffer, only filled while the depth view is shown
+        self.display = None  # FrameDisplay of video_label, roi_coords are in its display pixels
+        self.tracker = None  # LordeTracker of the last ROI while tracking is switched on
+        self.tracking = None  # RingWorker running the tracker on the newest frames, off the Tk thread
+        self.tracked = None  # its newest {'matched_boxes', 'computed_depths'}
 
         # Camera flags
         self.running = False # Global flag to control video capture
@@ -77,6 +97,10 @@ class App(customtkinter.CTk):
         self.appearance_mode_optionemenu.grid(row=7, column=0, padx=20, pady=(10, 10))
         # set default appearance mode
         self.appearance_mode_optionemenu.set("Dark")
+        # live tracking of the ROI's matches #
+        self.track_var = tkinter.BooleanVar(value=False)
+        self.track_switch = customtkinter.CTkSwitch(self.sidebar_frame, text="Track ROI", variable=self.track_var, command=self.toggle_tracking, font=customtkinter.CTkFont(size=16))
+        self.track_switch.grid(row=5, column=0, padx=20, pady=(10, 10))
         ######################################################################################################################
 
         ########### Main frame widgets ########################################################################################
@@ -107,6 +131,9 @@ class App(customtkinter.CTk):
         
         self.progressbar_1 = customtkinter.CTkProgressBar(self.slider_progressbar_frame)
         self.progressbar_1.grid(row=0, column=0, pady=(10, 10), sticky="nsew")
+        # frames shown / dropped by the display
+        self.frame_stats_label = customtkinter.CTkLabel(self.slider_progressbar_frame, text="", anchor="w")
+        self.frame_stats_label.grid(row=1, column=0, sticky="nsew")
 
         #clip frame display
         self.clip_frame = customtkinter.CTkFrame(self, width=250)
@@ -133,79 +160,73 @@ class App(customtkinter.CTk):
     def change_appearance_mode_event(self, new_appearance_mode: str): # Event handler for changing the appearance mode
         customtkinter.set_appearance_mode(new_appearance_mode)
 
-    def start_video(self): # Start the video display
+    def start_video(self): # Start the capture thread and the video display
         self.running = True
+        if self.capture is None or not self.capture.is_alive():
+            self.capture = CaptureThread(self.grab, self.frame_ring)
+            self.capture.start()
         self.show_frame()
         self.start_stream.configure(state="disabled")
         self.stop_stream.configure(state="normal")
 
     
-    def stop_video(self):  # Freeze the video display
+    def stop_video(self):  # Freeze the video display and stop capturing
         self.running = False
+        if self.capture is not None:
+            self.capture.stop()
         self.start_stream.configure(state="normal")
         self.stop_stream.configure(state="disabled")
 
-    def show_frame(self): # Display the video frame, draw the ROI on top,
-        global frame_captured, depth_colormap, depth_image
-        if self.running:
-
-            frames = self.pipeline.wait_for_frames() # Align frames
-            align = rs.align(rs.stream.color)
-            frames = align.process(frames)
-
-            depth_frame = frames.get_depth_frame() # Get frame data
-            color_frame = frames.get_color_frame()
-            
-            if not depth_frame or not color_frame:
-                print("Failed to capture frame")
-                running = False
-                return
-            
-            # Convert images to numpy arrays
-            depth_image = np.asanyarray(depth_frame.get_data())
-            color_image = np.asanyarray(color_frame.get_data())
-
-            # Apply colormap on depth image (image must be converted to 8-bit per pixel first)
-            depth_colormap = cv2.applyColorMap(cv2.convertScaleAbs(depth_image, alpha=0.03), cv2.COLORMAP_JET)
-           
-            frame_captured = color_image
-            
-            if not self.radio_var.get(): # toggle between depth and color image
-                frame_captured_copy = depth_colormap
-            else:
-                frame_captured_copy = frame_captured.copy()
-            
-
-            # # get aspect ratio of the image
-            color_colormap_dim = color_image.shape
-            aspect_ratio = color_colormap_dim[1] / color_colormap_dim[0]
-            
-            display_width = 480
-            display_height = int(display_width / aspect_ratio)  
-
-            # Calculate scaling factor
-            scale_x = display_width / color_colormap_dim[1]
-            scale_y = display_height / color_colormap_dim[0]
-            
-            if self.roi_defined and self.roi_coords:
-                x1, y1, x2, y2 = self.roi_coords
-                cv2.rectangle(frame_captured_copy, (x1, y1), (x2, y2), (0, 255, 0), 2)  # Draw ROI in green
-
-            cv_rgb = cv2.cvtColor(frame_captured_copy, cv2.COLOR_BGR2RGB)
-            
-            img = Image.fromarray(cv_rgb)
-            my_image = customtkinter.CTkImage(light_image=img,dark_image=img, size=(display_width, display_height))
-            self.video_label.configure(image=my_image)
-            self.video_label.image = my_image
+    def show_frame(self): # Display the newest captured frame, draw the ROI on top,
+        if not self.running:
+            return
+        try:
+            self.render_frame()
+        finally: # an error in one frame must not stop the video loop
             self.video_label.after(10, self.show_frame)
 
+    def render_frame(self):
+        frame = self.frame_ring.latest()
+        if not self.frame_counter.update(frame): # nothing new since the last render
+            return
+        self.frame = frame
+        color_image, depth_image = frame.color, frame.depth
+
+        if self.display is None:
+            # 480 wide in widget units, in screen pixels so mouse events and the image agree
+            scaling = customtkinter.ScalingTracker.get_widget_scaling(self.video_label)
+            self.display = FrameDisplay(int(round(480 * scaling)))
+
+        # Resize to the label size first, everything after works on the small image
+        if not self.radio_var.get(): # toggle between depth and color image
+            small_depth = self.display.shrink(depth_image, interpolation=cv2.INTER_NEAREST)
+            self.depth_colormap = self.colorizer.colorize(small_depth, out=self.depth_colormap)
+            small = self.depth_colormap
+        else:
+            small = self.display.shrink(color_image)
+
+        boxes, labels = (), ()
+        if self.tracking is not None: # newest boxes from the tracking thread, drawn until the next ones arrive
+            result = self.tracking.poll()
+            if result is not None:
+                self.tracked = result[1]
+        if self.tracked is not None:
+            boxes = self.tracked['matched_boxes']
+            labels = ["%.1f m" % (computed if computed is not None else realsense)
+                      for computed, realsense in self.tracked['computed_depths']]
+
+        roi = self.roi_coords if self.roi_defined and self.roi_coords else None  # Draw ROI in green
+        self.display.show(self.video_label, self.display.render(small, roi, boxes, labels))
+        self.frame_stats_label.configure(text="Frames shown: %d   dropped: %d" % (
+            self.frame_counter.shown, self.frame_counter.dropped))
+
     def display_roi(self): # Display the selected region of interest, and save the images to jpgs
-        global frame_captured
-        if self.roi_coords and frame_captured is not None:
-            x1, y1, x2, y2 = self.roi_coords
-            roi = frame_captured[y1-10:y2+10, x1-10:x2+10]
-            depth_roi = depth_colormap[y1-10:y2+10, x1-10:x2+10]
-            #depth_roi_data = depth_image[y1-10:y2+10, x1-10:x2+10] #<-- ANDREW: this is the depth data for the ROI (HxWx1) to use for depth estimation
+        if self.roi_coords and self.frame is not None:
+            x1, y1, x2, y2 = self.display.to_sensor(self.roi_coords)  # full resolution pixels
+            x1, y1 = max(x1 - 10, 0), max(y1 - 10, 0)
+            roi = self.frame.color[y1:y2+10, x1:x2+10]
+            depth_roi = self.colorizer.colorize(self.frame.depth[y1:y2+10, x1:x2+10])
+            #depth_roi_data = self.frame.depth[y1-10:y2+10, x1-10:x2+10] #<-- ANDREW: this is the depth data for the ROI (HxWx1) to use for depth estimation
             print("x1: {}, y1: {}, x2: {}, y2: {}".format(x1, y1, x2, y2))
             roi = cv2.cvtColor(roi, cv2.COLOR_BGR2RGB)
 
@@ -221,6 +242,26 @@ class App(customtkinter.CTk):
         else: 
             print("No ROI coordinates defined, please select a region of interest first")
 
+    def toggle_tracking(self): # Track the matches of the current ROI on every frame, or stop tracking
+        if self.tracking is not None:
+            self.tracking.stop()
+        self.tracking = None
+        self.tracker = None
+        self.tracked = None
+        if self.track_var.get() and self.roi_coords and self.frame is not None:
+            roi = self.display.to_sensor(self.roi_coords)
+            if min(roi[2] - roi[0], roi[3] - roi[1]) < LordeTracker.MIN_ROI_SIZE: # a click without a drag
+                print("ROI too small to track, drag a larger region")
+                return
+            # Box depths from the median of the last 8 depth frames, steadier than a single noisy frame
+            # The color stream's calibration (the frames are aligned to it) rather than the FOV_PER_PIX guess
+            self.tracker = LordeTracker(roi, self.frame.color, intrinsics=self.grab.intrinsics, temporal=8)
+            # Follows the matched boxes, the full search (~0.6 s at 720p) only runs when they are lost
+            tracker = self.tracker
+            self.tracking = RingWorker(self.frame_ring, lambda frame: tracker.update(frame.color, frame.depth),
+                                       name='lorde-tracking')
+            self.tracking.start()
+
     def on_mouse_click(self, event): # Sets the starting coordinates of the ROI
         self.roi_start = (event.x, event.y)
         print("Mouse clicked at:", self.roi_start)
@@ -235,11 +276,19 @@ class App(customtkinter.CTk):
     def on_mouse_release(self,event):  # Update final coordinates of the ROI
         self.on_mouse_drag(event)  # Update coordinates
         self.display_roi()  # Display the selected ROI
+        self.toggle_tracking()  # a new ROI restarts tracking with its template
         self.roi_defined = False  # Reset flag after processing
         self.roi_start = None  # Reset start coordinates
 
     def exit(self): # Qxit the application
+        self.running = False
+        if self.tracking is not None:
+            self.tracking.stop()
+        if self.capture is not None:
+            self.capture.stop()
+        self.source.stop()
         self.destroy()
 if __name__ == "__main__":
-    app = App()
+    # python app2.py [recording_dir] replays a recorded directory (e.g. calibration_images) instead of the camera
+    app = App(RecordedSource(directory=sys.argv[1]).start() if len(sys.argv) > 1 else None)
     app.mainloop()
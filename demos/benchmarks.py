@@ -0,0 +1,446 @@
+"""
+Offline benchmarks for the LoRDE helpers in utils.py
+
+Runs on the recorded frames in calibration_images/, no camera needed.
+
+Usage:
+------
+    python benchmarks.py                          Time every LoRDE stage at 640x480 and 1280x720
+    python benchmarks.py --output results.json    ... and write the percentiles as JSON
+    python benchmarks.py --baseline results.json --threshold 1.25
+                                                  ... and exit 1 if a stage's median got 25% slower
+    python benchmarks.py --compare                Compare the optimized helpers against the originals
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import cv2
+import numpy as np
+
+import utils
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+COLOR_PATH = os.path.join(HERE, 'calibration_images/cone_color2.png')
+DEPTH_PATH = os.path.join(HERE, 'calibration_images/cone_depth_array2.npy')
+ROI = (340, 200, 400, 310)  # x1, y1, x2, y2 of the near cone, as in template_matching.ipynb
+
+
+def load_recording(size=None):
+    # Load the recorded cone frame, optionally resized to (width, height)
+    color = cv2.imread(COLOR_PATH)
+    depth = np.load(DEPTH_PATH)
+    if size is not None and color.shape[1::-1] != tuple(size):
+        color = cv2.resize(color, tuple(size))
+        depth = cv2.resize(depth, tuple(size), interpolation=cv2.INTER_NEAREST)
+    return color, depth
+
+
+def time_call(fn, *args, repeat=20, warmup=2, **kwargs):
+    # Wall time of each call in milliseconds
+    for _ in range(warmup):
+        fn(*args, **kwargs)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args, **kwargs)
+        times.append((time.perf_counter() - start) * 1000)
+    return np.array(times)
+
+
+def report(name, times):
+    print('%-40s median %8.2f ms   min %8.2f ms' % (name, np.median(times), times.min()))
+
+
+def legacy_color_selection_mask(image, target_hsv=list):
+    # Reference copy of the original implementation, with the hard coded 480x640 tile
+    # replaced by the frame shape so it can run at 720p
+    img_hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
+    target_hsv = np.tile(target_hsv, (image.shape[0], image.shape[1], 1))
+
+    distance = np.zeros(img_hsv.shape)
+    h_distance = np.minimum(np.abs(img_hsv[:,:,0:1] - target_hsv[:,:,0:1]), 180 - np.abs(img_hsv[:,:,0:1] - target_hsv[:,:,0:1]))
+    sv_distance = img_hsv[:,:,1:] - target_hsv[:,:,1:]
+
+    distance[:,:,0:1] = h_distance
+    distance[:,:,1:] = sv_distance
+
+    distance = np.linalg.norm(distance, axis=2)
+    distance = 255 * distance / distance.max()
+    distance = 255 - distance.astype(np.uint8)
+
+    return distance
+
+
+def bench_color_selection_mask(sizes=((640, 480), (1280, 720)), target_hsv=(0, 255, 255)):
+    for size in sizes:
+        color, _ = load_recording(size)
+        label = '%dx%d' % size
+
+        legacy = legacy_color_selection_mask(color, list(target_hsv))
+        current = utils.color_selection_mask(color, list(target_hsv))
+        mismatched = np.count_nonzero(legacy != current)
+        print('color_selection_mask %s: %d of %d pixels differ from legacy' % (label, mismatched, legacy.size))
+
+        out = np.empty(color.shape[:2], dtype=np.uint8)
+        report('legacy color_selection_mask ' + label, time_call(legacy_color_selection_mask, color, list(target_hsv)))
+        report('color_selection_mask ' + label, time_call(utils.color_selection_mask, color, list(target_hsv), out=out))
+
+
+def inpaint_box(image, box):
+    # Same masking find_matching_boxes applies before looking for the next object
+    mask = np.zeros_like(image)
+    cv2.rectangle(mask, box[0], box[1], 255, -1)
+    return cv2.inpaint(image, mask, 3, cv2.INPAINT_TELEA)
+
+
+def bench_template_matching(roi=ROI):
+    color, _ = load_recording()
+    x1, y1, x2, y2 = roi
+    img = utils.color_selection_mask(color, [0, 255, 255])
+    template_canny = utils.auto_canny(img[y1:y2, x1:x2])
+
+    # The near cone is the template itself, the far cone is searched for after inpainting the near one
+    cases = [('near', img), ('far', inpaint_box(img, ((x1, y1), (x2, y2))))]
+    for name, image in cases:
+        grid = utils.multiscale_template_matching(image, template_canny)
+        refined = utils.multiscale_template_matching(image, template_canny, coarse_to_fine=True)
+        print('%s cone: grid %s scale %.3f, coarse-to-fine %s scale %.3f, IoU %.3f' % (
+            name, grid['box'], grid['scale'], refined['box'], refined['scale'], utils.box_iou(grid['box'], refined['box'])))
+        report('grid multiscale_template_matching', time_call(
+            utils.multiscale_template_matching, image, template_canny, repeat=3, warmup=0))
+        report('coarse-to-fine multiscale_template_matching', time_call(
+            utils.multiscale_template_matching, image, template_canny, coarse_to_fine=True))
+
+
+def bench_parallel_matching(worker_counts=(1, 2, 4, 8), roi=ROI):
+    color, _ = load_recording()
+    x1, y1, x2, y2 = roi
+    img = utils.color_selection_mask(color, [0, 255, 255])
+    template_canny = utils.auto_canny(img[y1:y2, x1:x2])
+    image = inpaint_box(img, ((x1, y1), (x2, y2)))
+
+    # Keep OpenCV's own threading out of the way so the speedup comes from the scale pool alone
+    cv_threads = cv2.getNumThreads()
+    cv2.setNumThreads(1)
+    try:
+        serial = utils.multiscale_template_matching(image, template_canny)
+        baseline = None
+        for workers in worker_counts:
+            parallel = utils.multiscale_template_matching(image, template_canny, workers=workers)
+            times = time_call(utils.multiscale_template_matching, image, template_canny,
+                              workers=workers, repeat=3, warmup=0)
+            baseline = np.median(times) if baseline is None else baseline
+            report('grid matching, %d workers' % workers, times)
+            print('    speedup %.2fx, same answer as serial: %s' % (
+                baseline / np.median(times), parallel == serial))
+    finally:
+        cv2.setNumThreads(cv_threads)
+
+
+def legacy_find_matching_boxes(image, template, max_matching_objects=2):
+    # Reference copy of the original search-then-inpaint loop, one full grid search per object
+    matched_boxes = []
+    scales = []
+    matching_img = image.copy()
+    template_canny = utils.auto_canny(template)
+    for i in range(max_matching_objects):
+        output = utils.multiscale_template_matching(matching_img, template_canny)
+        matched_boxes.append(output['box'])
+        scales.append(output['scale'])
+        if i < max_matching_objects - 1:
+            matching_img = inpaint_box(matching_img, output['box'])
+    return matched_boxes, scales
+
+
+def bench_find_matching_boxes(object_counts=(1, 2, 3, 4), roi=ROI):
+    color, _ = load_recording()
+    x1, y1, x2, y2 = roi
+    img = utils.color_selection_mask(color, [0, 255, 255])
+    template = img[y1:y2, x1:x2]
+
+    for n in object_counts:
+        legacy_boxes, _ = legacy_find_matching_boxes(img, template, n)
+        grid_boxes, _ = utils.find_matching_boxes(img, template, n, coarse_to_fine=False)
+        print('%d objects: inpaint loop %s' % (n, legacy_boxes))
+        print('%d objects: single pass  %s' % (n, grid_boxes))
+        report('inpaint loop, %d objects' % n, time_call(
+            legacy_find_matching_boxes, img, template, n, repeat=1, warmup=0))
+        report('single pass grid, %d objects' % n, time_call(
+            utils.find_matching_boxes, img, template, n, coarse_to_fine=False, repeat=1, warmup=0))
+        report('single pass coarse-to-fine, %d objects' % n, time_call(
+            utils.find_matching_boxes, img, template, n, repeat=5))
+
+
+def bench_edge_cache(templates=3, roi=ROI):
+    color, _ = load_recording()
+    x1, y1, x2, y2 = roi
+    img = utils.color_selection_mask(color, [0, 255, 255])
+    # Several templates cut around the same ROI, all searched on the same frame
+    rois = [(x1 + dx, y1 + dy, x2 + dx, y2 + dy) for dx, dy in [(0, 0), (-4, 2), (3, -3), (2, 4)][:templates]]
+
+    def search_all(edge_cache, coarse_to_fine):
+        for (a, b, c, d) in rois:
+            utils.find_matching_boxes(img, img[b:d, a:c], coarse_to_fine=coarse_to_fine, edge_cache=edge_cache)
+
+    for coarse_to_fine in (True, False):
+        mode = 'coarse-to-fine' if coarse_to_fine else 'grid'
+        repeat = 5 if coarse_to_fine else 1
+        report('%d templates, %s, no cache' % (len(rois), mode), time_call(
+            search_all, None, coarse_to_fine, repeat=repeat, warmup=0))
+        edge_cache = utils.EdgePyramid()
+        report('%d templates, %s, edge cache' % (len(rois), mode), time_call(
+            lambda: (edge_cache.reset(img), search_all(edge_cache, coarse_to_fine)), repeat=repeat, warmup=0))
+        print('    cache stats over all runs: %s' % edge_cache.stats)
+
+
+def bench_box_medians(size=(1280, 720)):
+    depth_paths = [DEPTH_PATH, os.path.join(HERE, 'calibration_images/paper_depth_array.npy')]
+    for path in depth_paths:
+        depth = cv2.resize(np.load(path), size, interpolation=cv2.INTER_NEAREST)
+        (W, H) = size
+        # Near and far cone boxes scaled to the frame, plus a large and a full frame box
+        sx, sy = W / 640.0, H / 480.0
+        boxes = np.array([[340 * sx, 200 * sy, 400 * sx, 310 * sy], [296 * sx, 237 * sy, 324 * sx, 289 * sy],
+                          [W // 4, H // 4, 3 * W // 4, 3 * H // 4], [0, 0, W, H]], dtype=np.int64)
+
+        def legacy(depth, boxes):
+            return [np.median(depth[y1:y2, x1:x2].astype(np.float64)) for (x1, y1, x2, y2) in boxes]
+
+        def masked(depth, boxes):
+            medians = []
+            for (x1, y1, x2, y2) in boxes:
+                roi = depth[y1:y2, x1:x2]
+                medians.append(np.median(roi[roi > 0]))
+            return medians
+
+        medians, valid_fraction = utils.box_medians(depth, boxes)
+        label = '%s %dx%d' % (os.path.basename(path), W, H)
+        print('%s: medians %s, with zeros %s, valid fractions %s' % (
+            label, medians, np.array(legacy(depth, boxes)), np.round(valid_fraction, 3)))
+        print('    matches masked np.median: %s' % np.allclose(medians, masked(depth, boxes)))
+        report('np.median per box', time_call(legacy, depth, boxes))
+        report('masked np.median per box', time_call(masked, depth, boxes))
+        report('histogram box_medians', time_call(utils.box_medians, depth, boxes))
+
+
+def panned_frames(color, depth, n, step=(2, 1)):
+    # A simulated camera pan, frame t is the recording shifted by t * step pixels
+    for t in range(n):
+        M = np.float32([[1, 0, t * step[0]], [0, 1, t * step[1]]])
+        yield (t, cv2.warpAffine(color, M, color.shape[1::-1], borderMode=cv2.BORDER_REPLICATE),
+               cv2.warpAffine(depth, M, depth.shape[1::-1], flags=cv2.INTER_NEAREST))
+
+
+def bench_tracking(sizes=((640, 480), (1280, 720)), frames=30):
+    for size in sizes:
+        color, depth = load_recording(size)
+        roi = scaled_roi(size)
+        k = size[0] / 640.0
+        step = (2 * k, 1 * k)
+        tracker = utils.LordeTracker(roi, color)
+        tracked, full, drift = [], [], 0
+        for t, c, d in panned_frames(color, depth, frames, step):
+            start = time.perf_counter()
+            out = tracker.update(c, d)
+            tracked.append((time.perf_counter() - start) * 1000)
+            moved = tuple(int(v + t * step[i % 2]) for i, v in enumerate(roi))
+            start = time.perf_counter()
+            ref = utils.lorde_from_roi(moved, c, d)
+            full.append((time.perf_counter() - start) * 1000)
+            drift = max([drift] + [abs(a - b) for box, ref_box in zip(out['matched_boxes'], ref['matched_boxes'])
+                                   for p, q in zip(box, ref_box) for a, b in zip(p, q)])
+        print('%dx%d pan over %d frames: %d full searches, max corner drift from a full search %d px' % (
+            size[0], size[1], frames, tracker.tracker.full_searches, drift))
+        report('lorde_from_roi every frame', np.array(full))
+        report('LordeTracker after the first frame', np.array(tracked[1:]))
+
+
+def noisy_depth(depth, rng, sigma_at_1m=0.004, dropout=0.2, depth_scale=utils.DEPTH_SCALE):
+    # The recorded z16 frame with RealSense-like noise: error growing with the square of the distance and
+    # a fraction of pixels dropped to 0 (invalid)
+    z = depth.astype(np.float64) * depth_scale
+    noisy = z + rng.normal(size=z.shape) * sigma_at_1m * z ** 2
+    noisy[(rng.random(z.shape) < dropout) | (depth == 0)] = 0
+    return np.round(np.clip(noisy, 0, None) / depth_scale).astype(np.uint16)
+
+
+def bench_depth_accumulator(k=8, frames=40, size=(640, 480)):
+    _, depth = load_recording(size)
+    boxes = np.array([[340, 200, 400, 310], [296, 237, 324, 289]]) * np.array(size * 2) // np.array([640, 480] * 2)
+    truth, _ = utils.box_medians(depth, boxes)
+    rng = np.random.default_rng(0)
+    accumulator = utils.DepthAccumulator(k)
+    single, temporal, update_ms, median_ms = [], [], [], []
+    for _ in range(frames):
+        frame = noisy_depth(depth, rng)
+        start = time.perf_counter()
+        accumulator.update(frame)
+        update_ms.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        median = accumulator.median()
+        median_ms.append((time.perf_counter() - start) * 1000)
+        single.append(utils.box_medians(frame, boxes)[0] - truth)
+        if len(accumulator) == k:
+            temporal.append(utils.box_medians(median, boxes)[0] - truth)
+    print('%dx%d, %d noisy frames: box median RMS error vs the clean frame (z16 units, near / far box)' % (
+        size[0], size[1], frames))
+    print('    single frame %s, temporal median of %d %s' % (
+        np.sqrt(np.mean(np.square(single), axis=0)).round(2), k, np.sqrt(np.mean(np.square(temporal), axis=0)).round(2)))
+    report('DepthAccumulator.update', np.array(update_ms))
+    report('DepthAccumulator.median (full frame)', np.array(median_ms))
+
+
+SIZES = ((640, 480), (1280, 720))
+PERCENTILES = (50, 90, 99)
+
+
+def bench_deprojection(sizes=((640, 480), (1280, 720)), pixels=2000):
+    # Per-pixel deprojection as in measure_new.py and the notebooks (rs.rs2_deproject_pixel_to_point when
+    # pyrealsense2 is installed, else the same pinhole formula in Python) against the cached ray table
+    try:
+        import pyrealsense2 as rs
+    except ImportError:
+        rs = None
+    from frame_source import make_intrinsics
+    for size in sizes:
+        _, depth = load_recording(size)
+        intrinsics = make_intrinsics(*utils.default_intrinsics(*size))
+        table = utils.ray_table(intrinsics)
+        ys, xs = np.nonzero(depth)
+        xs, ys = xs[:pixels], ys[:pixels]
+        z = depth[ys, xs] * utils.DEPTH_SCALE
+
+        if rs is not None:
+            def per_pixel():
+                return [rs.rs2_deproject_pixel_to_point(intrinsics, [float(x), float(y)], float(d)) for x, y, d in zip(xs, ys, z)]
+        else:
+            def per_pixel():
+                return [[(x - intrinsics.ppx) / intrinsics.fx * d, (y - intrinsics.ppy) / intrinsics.fy * d, d]
+                        for x, y, d in zip(xs, ys, z)]
+        points = table.deproject_pixels(np.stack([xs, ys], axis=1), depth)
+        assert np.allclose(points, per_pixel(), atol=1e-5)
+        print('%dx%d:' % size)
+        report('%d pixels one at a time' % pixels, time_call(per_pixel, repeat=5))
+        report('%d pixels, ray table' % pixels, time_call(table.deproject_pixels, np.stack([xs, ys], axis=1), depth))
+        out = table.deproject(depth)
+        report('full frame, ray table', time_call(table.deproject, depth, out=out))
+        decimated = cv2.resize(depth, (size[0] // 2, size[1] // 2), interpolation=cv2.INTER_NEAREST)
+        report('full frame decimated by 2, ray table', time_call(utils.ray_table(intrinsics, decimate=2).deproject, decimated))
+
+
+def scaled_roi(size, roi=ROI):
+    # The recorded ROI mapped onto a frame resized to (width, height)
+    sx, sy = size[0] / 640.0, size[1] / 480.0
+    x1, y1, x2, y2 = roi
+    return (int(x1 * sx), int(y1 * sy), int(x2 * sx), int(y2 * sy))
+
+
+def summarize(times):
+    summary = {'p%d' % q: float(np.percentile(times, q)) for q in PERCENTILES}
+    summary.update({'min': float(times.min()), 'mean': float(times.mean()), 'n': int(len(times))})
+    return summary
+
+
+def lorde_stages(size, grid=False):
+    # (stage name, callable, repeat) for every stage of lorde_from_roi on the recorded frame at size
+    color, depth = load_recording(size)
+    x1, y1, x2, y2 = scaled_roi(size)
+    img = utils.color_selection_mask(color, [0, 255, 255])
+    template = img[y1:y2, x1:x2]
+    template_canny = utils.auto_canny(template)
+    boxes, _ = utils.find_matching_boxes(img, template)
+
+    stages = [
+        ('color_selection_mask', lambda: utils.color_selection_mask(color, [0, 255, 255]), 50),
+        ('auto_canny', lambda: utils.auto_canny(img), 50),
+        # Named after the mode timed, a plain multiscale_template_matching call runs the exhaustive grid
+        ('multiscale_template_matching_c2f', lambda: utils.multiscale_template_matching(
+            img, template_canny, coarse_to_fine=True), 10),
+        ('find_matching_boxes', lambda: utils.find_matching_boxes(img, template), 10),
+        ('depth_from_boxes', lambda: utils.depth_from_boxes(depth, boxes), 50),
+        ('lorde_from_roi', lambda: utils.lorde_from_roi((x1, y1, x2, y2), color, depth), 10),
+    ]
+    if grid:
+        # The exhaustive grid takes seconds per call, so it only runs on request
+        stages.append(('multiscale_template_matching_grid', lambda: utils.multiscale_template_matching(
+            img, template_canny), 3))
+    return stages
+
+
+def run_suite(sizes=SIZES, repeat_scale=1.0, grid=False, stages=None):
+    # Percentile timings in ms keyed by 'stage@WxH'
+    results = {}
+    for size in sizes:
+        for name, fn, repeat in lorde_stages(size, grid):
+            if stages and name not in stages:
+                continue
+            key = '%s@%dx%d' % ((name,) + tuple(size))
+            times = time_call(fn, repeat=max(1, int(repeat * repeat_scale)), warmup=1)
+            results[key] = summarize(times)
+            print('%-50s p50 %9.2f ms   p90 %9.2f ms   p99 %9.2f ms' % (
+                key, results[key]['p50'], results[key]['p90'], results[key]['p99']))
+    return results
+
+
+def check_regressions(results, baseline, threshold, metric='p50'):
+    # Stages whose metric grew by more than threshold times the baseline
+    regressions = []
+    for key, summary in results.items():
+        if key in baseline and summary[metric] > threshold * baseline[key][metric]:
+            regressions.append((key, baseline[key][metric], summary[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline LoRDE benchmarks on the recorded cone frames')
+    parser.add_argument('--output', help='write the results as JSON to this path')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='fail when a stage is slower than threshold x baseline (default 1.25)')
+    parser.add_argument('--metric', default='p50', choices=['p%d' % q for q in PERCENTILES] + ['min', 'mean'],
+                        help='statistic compared against the baseline (default p50)')
+    parser.add_argument('--stage', action='append', help='only run this stage, may be repeated')
+    parser.add_argument('--size', action='append', help='frame size as WxH, may be repeated')
+    parser.add_argument('--repeat-scale', type=float, default=1.0, help='multiply every stage\'s repeat count')
+    parser.add_argument('--grid', action='store_true', help='also time the exhaustive scale grid')
+    parser.add_argument('--compare', action='store_true', help='run the comparisons against the original helpers')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        bench_color_selection_mask()
+        bench_template_matching()
+        bench_parallel_matching()
+        bench_find_matching_boxes()
+        bench_edge_cache()
+        bench_box_medians()
+        bench_tracking()
+        bench_depth_accumulator()
+        bench_deprojection()
+        return 0
+
+    sizes = [tuple(int(v) for v in s.lower().split('x')) for s in args.size] if args.size else SIZES
+    results = run_suite(sizes, args.repeat_scale, args.grid, args.stage)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'results': results, 'machine': platform.platform(), 'python': platform.python_version(),
+                       'opencv': cv2.__version__, 'numpy': np.__version__, 'time': time.time()}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = check_regressions(results, baseline, args.threshold, args.metric)
+        for key, before, after in regressions:
+            print('REGRESSION %s: %s %.2f ms -> %.2f ms (%.2fx, threshold %.2fx)' % (
+                key, args.metric, before, after, after / before, args.threshold))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
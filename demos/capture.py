@@ -0,0 +1,187 @@
+"""
+Background frame capture for the LoRDE apps
+
+A CaptureThread calls a grab function (e.g. a SourceGrabber over a frame_source) in a loop and
+writes every frame into a bounded FrameRing. The UI thread only ever reads the newest frame,
+so a capture stall never blocks it and frames the UI was too slow to show are counted as dropped.
+
+Usage:
+------
+    python capture.py     Replay calibration_images/ through the ring and report dropped frames
+"""
+
+import collections
+import queue
+import threading
+import time
+import numpy as np
+
+from frame_source import EndOfStream, RecordedSource
+
+# One captured frame, index counts every frame the capture thread produced
+Frame = collections.namedtuple('Frame', ['index', 'timestamp', 'color', 'depth'])
+
+
+class FrameRing:
+    # Bounded ring of the newest frames, written by the capture thread and read by the UI thread
+
+    def __init__(self, capacity=4):
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self._count = 0
+        self._cond = threading.Condition()
+
+    def put(self, color, depth, timestamp=None):
+        with self._cond:
+            frame = Frame(self._count, time.time() if timestamp is None else timestamp, color, depth)
+            self._slots[self._count % self.capacity] = frame
+            self._count += 1
+            self._cond.notify_all()
+        return frame
+
+    def latest(self):
+        # Newest frame, or None before the first one arrives
+        with self._cond:
+            return self._slots[(self._count - 1) % self.capacity] if self._count else None
+
+    def wait_newer(self, index, timeout=None):
+        # Newest frame once its index is greater than index, None on timeout
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._count - 1 > index, timeout):
+                return None
+            return self._slots[(self._count - 1) % self.capacity]
+
+    def __len__(self):
+        return self._count
+
+
+class FrameCounter:
+    # Frames shown and dropped by a consumer that only looks at the newest frame of a FrameRing
+
+    def __init__(self):
+        self.last_index = -1
+        self.shown = 0
+        self.dropped = 0
+
+    def update(self, frame):
+        # True when frame is newer than the last one shown, counting the ones skipped in between
+        if frame is None or frame.index <= self.last_index:
+            return False
+        self.dropped += frame.index - self.last_index - 1
+        self.last_index = frame.index
+        self.shown += 1
+        return True
+
+
+class CaptureThread(threading.Thread):
+    # Runs grab() until stopped and puts each (color, depth[, timestamp]) it returns into the ring.
+    # grab returning None ends the stream, exceptions (e.g. wait_for_frames timeouts) are counted and skipped
+
+    def __init__(self, grab, ring, name='lorde-capture'):
+        super().__init__(name=name, daemon=True)
+        self.grab = grab
+        self.ring = ring
+        self.errors = 0
+        self.last_error = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                grabbed = self.grab()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+                continue
+            if grabbed is None:
+                break
+            self.ring.put(*grabbed)
+
+    def stop(self, timeout=1.0):
+        self._stop_event.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
+
+class RingWorker(threading.Thread):
+    # Runs process(frame) on the newest frame of a FrameRing whenever a newer one arrives, so slow per-frame
+    # work (e.g. LordeTracker.update) stays off the UI thread. Frames that arrive while it is busy are skipped.
+    # Results go to a queue the UI polls with poll(), errors are counted and skipped like CaptureThread's
+
+    def __init__(self, ring, process, name='lorde-ring-worker'):
+        super().__init__(name=name, daemon=True)
+        self.ring = ring
+        self.process = process
+        self.results = queue.Queue()
+        self.errors = 0
+        self.last_error = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        index = -1
+        while not self._stop_event.is_set():
+            frame = self.ring.wait_newer(index, timeout=0.1)
+            if frame is None:
+                continue
+            index = frame.index
+            try:
+                result = self.process(frame)
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+                continue
+            if not self._stop_event.is_set():
+                self.results.put((frame, result))
+
+    def poll(self):
+        # Newest (frame, result) finished since the last poll, or None
+        newest = None
+        while True:
+            try:
+                newest = self.results.get_nowait()
+            except queue.Empty:
+                return newest
+
+    def stop(self, timeout=1.0):
+        self._stop_event.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
+
+class SourceGrabber:
+    # Waits for a frameset from a frame_source (live or recorded) and copies color and depth to numpy
+    # arrays so the librealsense frame buffers are released immediately. intrinsics is the color stream's
+    # calibration, read from the first frame. Returns None at the end of a recording, which ends the CaptureThread
+
+    def __init__(self, source):
+        self.source = source
+        self.intrinsics = None
+
+    def __call__(self):
+        try:
+            frames = self.source.wait_for_frames()
+        except EndOfStream:
+            return None
+        depth_frame = frames.get_depth_frame()
+        color_frame = frames.get_color_frame()
+        if not depth_frame or not color_frame:
+            raise RuntimeError('Failed to capture frame')
+        if self.intrinsics is None:
+            self.intrinsics = color_frame.profile.as_video_stream_profile().intrinsics
+        color = np.array(color_frame.get_data())
+        depth = np.array(depth_frame.get_data())
+        return color, depth, frames.get_timestamp() / 1000.0
+
+
+if __name__ == '__main__':
+    # Consume a 30 fps replay at ~10 fps, about two of every three frames should be dropped
+    ring = FrameRing()
+    capture = CaptureThread(SourceGrabber(RecordedSource(fps=30)), ring)
+    capture.start()
+    counter = FrameCounter()
+    start = time.time()
+    while time.time() - start < 3:
+        counter.update(ring.latest())
+        time.sleep(0.1)
+    capture.stop()
+    print('captured %d, shown %d, dropped %d, errors %d' % (len(ring), counter.shown, counter.dropped, capture.errors))
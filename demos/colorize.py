@@ -0,0 +1,61 @@
+"""
+Shared depth colorizer for the apps and the point cloud viewer
+
+DepthColorizer maps z16 depth to BGR with the same colors the apps always used,
+applyColorMap(convertScaleAbs(depth, alpha), COLORMAP_JET), writing into reused buffers.
+Callers only colorize when the depth view is actually shown.
+
+A precomputed 65536-entry uint16 -> BGR table gives identical colors but a single NumPy gather
+through it measured slower than OpenCV's fused scale + colormap (640x480: 1.3 vs 0.65 ms,
+1280x720: 4.0 vs 1.4 ms, still 2.1 ms with BGR packed into uint32), so the table is only built
+by lut() for callers that want it.
+
+Usage:
+------
+    python colorize.py     Time colorize() against the table gather on the recorded cone depth
+"""
+
+import os
+import timeit
+import cv2
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class DepthColorizer:
+    # z16 depth -> BGR colormap, alpha scales depth units to 0..255 (0.03: saturates at ~8.5 m)
+
+    def __init__(self, alpha=0.03, colormap=cv2.COLORMAP_JET):
+        self.alpha = alpha
+        self.colormap = colormap
+        self._scaled = None
+
+    def colorize(self, depth, out=None):
+        # BGR image of depth, written into out when it has the right shape (pass the previous result to reuse it)
+        if out is None or out.shape != depth.shape + (3,):
+            out = np.empty(depth.shape + (3,), dtype=np.uint8)
+        if self._scaled is None or self._scaled.shape != depth.shape:
+            self._scaled = np.empty(depth.shape, dtype=np.uint8)
+        cv2.convertScaleAbs(depth, self._scaled, alpha=self.alpha)
+        return cv2.applyColorMap(self._scaled, self.colormap, out)
+
+    def lut(self):
+        # (65536, 3) table of the color of every z16 value
+        values = np.arange(65536, dtype=np.uint16).reshape(-1, 1)
+        return self.colorize(values).reshape(65536, 3)
+
+
+if __name__ == '__main__':
+    depth = np.load(os.path.join(HERE, 'calibration_images', 'cone_depth_array2.npy'))
+    colorizer = DepthColorizer()
+    table = colorizer.lut()
+    for size in [(640, 480), (1280, 720)]:
+        d = cv2.resize(depth, size, interpolation=cv2.INTER_NEAREST)
+        out = colorizer.colorize(d)
+        gathered = np.empty_like(out)
+        assert (np.take(table, d, axis=0, out=gathered) == out).all()
+        for name, fn in [('colorize', lambda: colorizer.colorize(d, out)),
+                         ('table gather', lambda: np.take(table, d, axis=0, out=gathered))]:
+            ms = min(timeit.repeat(fn, number=50, repeat=5)) / 50 * 1000
+            print('%dx%d %-12s %.2f ms' % (size[0], size[1], name, ms))
@@ -0,0 +1,113 @@
+"""
+Display stage for showing camera frames in a Tk label
+
+FrameDisplay resizes each frame to the label size in OpenCV, converts it to RGB once into a
+reused buffer and pastes it into one persistent PhotoImage, instead of building a new PIL image
+and CTkImage per frame and letting customtkinter resample the full frame. It also keeps the
+display <-> sensor transform so ROIs drawn on the label map back to full resolution pixels.
+
+Usage:
+------
+    python display.py     Time the old and new display paths (without Tk) on a 1280x720 frame
+"""
+
+import os
+import timeit
+import cv2
+import numpy as np
+from PIL import Image
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class FrameDisplay:
+    # Renders frames at width display pixels wide (height from the frame aspect ratio)
+
+    def __init__(self, width=480):
+        self.width = width
+        self.size = None          # (width, height) on screen
+        self.sensor_size = None   # (width, height) of the frames
+        self._small = None
+        self._rgb = None
+        self.photo = None
+
+    def fit(self, shape):
+        # Set the display size for frames of shape (H, W[, C])
+        sensor_size = (shape[1], shape[0])
+        if sensor_size != self.sensor_size:
+            self.sensor_size = sensor_size
+            self.size = (self.width, max(1, int(round(self.width * shape[0] / float(shape[1])))))
+        return self.size
+
+    def to_sensor(self, roi):
+        # (x1, y1, x2, y2) in display pixels -> full resolution pixels, clipped to the frame
+        sx = self.sensor_size[0] / float(self.size[0])
+        sy = self.sensor_size[1] / float(self.size[1])
+        x1, y1, x2, y2 = roi
+        return (int(np.clip(round(x1 * sx), 0, self.sensor_size[0])), int(np.clip(round(y1 * sy), 0, self.sensor_size[1])),
+                int(np.clip(round(x2 * sx), 0, self.sensor_size[0])), int(np.clip(round(y2 * sy), 0, self.sensor_size[1])))
+
+    def to_display(self, roi):
+        # (x1, y1, x2, y2) in full resolution pixels -> display pixels
+        sx = self.size[0] / float(self.sensor_size[0])
+        sy = self.size[1] / float(self.sensor_size[1])
+        x1, y1, x2, y2 = roi
+        return (int(round(x1 * sx)), int(round(y1 * sy)), int(round(x2 * sx)), int(round(y2 * sy)))
+
+    def shrink(self, image, interpolation=cv2.INTER_AREA):
+        # image resized to the display size (use INTER_NEAREST for depth), into a reused buffer
+        size = self.fit(image.shape)
+        shape = (size[1], size[0]) + image.shape[2:]
+        if self._small is None or self._small.shape != shape or self._small.dtype != image.dtype:
+            self._small = np.empty(shape, dtype=image.dtype)
+        return cv2.resize(image, size, self._small, interpolation=interpolation)
+
+    def render(self, small_bgr, roi=None, boxes=(), labels=()):
+        # RGB image of a display sized BGR image with the ROI (display pixels) drawn in green, and
+        # ((x1, y1), (x2, y2)) boxes in sensor pixels drawn in red with an optional text label each
+        if self._rgb is None or self._rgb.shape != small_bgr.shape:
+            self._rgb = np.empty_like(small_bgr)
+        rgb = cv2.cvtColor(small_bgr, cv2.COLOR_BGR2RGB, self._rgb)
+        if roi:
+            x1, y1, x2, y2 = roi
+            cv2.rectangle(rgb, (x1, y1), (x2, y2), (0, 255, 0), 2)
+        for i, box in enumerate(boxes):
+            label = labels[i] if i < len(labels) else None
+            x1, y1, x2, y2 = self.to_display((box[0][0], box[0][1], box[1][0], box[1][1]))
+            cv2.rectangle(rgb, (x1, y1), (x2, y2), (255, 0, 0), 2)
+            if label:
+                cv2.putText(rgb, label, (x1, max(y1 - 5, 10)), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 0, 0), 1)
+        return rgb
+
+    def show(self, label, rgb):
+        # Paste rgb into the label's PhotoImage, creating it only when the size changes
+        from PIL import ImageTk
+        img = Image.fromarray(rgb)
+        if self.photo is None or (self.photo.width(), self.photo.height()) != img.size:
+            self.photo = ImageTk.PhotoImage(image=img)
+            label.configure(image=self.photo)
+            label.image = self.photo  # Keep reference
+        else:
+            self.photo.paste(img)
+        return self.photo
+
+
+if __name__ == '__main__':
+    color = cv2.resize(cv2.imread(os.path.join(HERE, 'calibration_images', 'cone_color2.png')), (1280, 720))
+    display = FrameDisplay(480)
+    roi = (120, 70, 160, 110)
+
+    def old_path():
+        # copy, draw, full size cvtColor and PIL image, resampled by CTkImage
+        frame = color.copy()
+        cv2.rectangle(frame, (roi[0], roi[1]), (roi[2], roi[3]), (0, 255, 0), 2)
+        img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        return img.resize((480, 270))
+
+    def new_path():
+        return Image.fromarray(display.render(display.shrink(color), roi))
+
+    for name, fn in [('old', old_path), ('new', new_path)]:
+        ms = min(timeit.repeat(fn, number=50, repeat=5)) / 50 * 1000
+        print('%s display path: %.2f ms per 1280x720 frame' % (name, ms))
+    print('display ROI %s -> sensor ROI %s' % (roi, display.to_sensor(roi)))
@@ -0,0 +1,276 @@
+"""
+Frame sources with the pyrealsense2 pipeline interface
+
+LiveSource wraps a running rs.pipeline and RecordedSource replays a directory of recorded
+<name>_color<n>.png + <name>_depth_array<n>.npy pairs (e.g. calibration_images/). Both return
+framesets from wait_for_frames() with get_depth_frame()/get_color_frame(), and frames with
+get_data(), get_timestamp(), get_distance() and profile intrinsics, so the apps can run and be
+profiled without a camera. Directories written by rgbd_recording are decoded lazily through its
+RecordingReader. Processing blocks (rs.align) are built once per source, not per frame.
+
+Usage:
+------
+    python frame_source.py                      Replay calibration_images/ as fast as possible and report fps
+    python frame_source.py <dir> [fps]          Replay a recording directory at fps (0 = as fast as possible)
+"""
+
+import collections
+import json
+import os
+import sys
+import time
+import cv2
+import numpy as np
+
+try:
+    import pyrealsense2 as rs
+except ImportError:  # Recorded sources work without librealsense
+    rs = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RECORDING_DIR = os.path.join(HERE, 'calibration_images')
+DEPTH_SCALE = 0.0010000000474974513  # meters per z16 depth unit
+FOV_PER_PIX = 0.1491                 # degrees per pixel at the image center, hand calibrated at 640x480
+
+# Stand-in for rs.intrinsics when librealsense is not installed, its fields are the ones every module reads
+Intrinsics = collections.namedtuple('Intrinsics', ['width', 'height', 'fx', 'fy', 'ppx', 'ppy'])
+INTRINSICS_FIELDS = Intrinsics._fields
+
+
+def default_intrinsics(width, height):
+    # Pinhole intrinsics equivalent to the hand calibrated FOV_PER_PIX at 640x480, scaled to the frame size,
+    # for recordings that were saved without their stream intrinsics
+    f = width / 640.0 / np.tan(np.deg2rad(FOV_PER_PIX))
+    return (width, height, f, f, width / 2.0, height / 2.0)
+
+
+class EndOfStream(RuntimeError):
+    # Raised by wait_for_frames of a RecordedSource that does not loop once every frame was played
+    pass
+
+
+def make_intrinsics(width, height, fx, fy, ppx, ppy):
+    # rs.intrinsics when pyrealsense2 is available (so rs.rs2_deproject_pixel_to_point accepts it), else Intrinsics
+    if rs is None:
+        return Intrinsics(int(width), int(height), float(fx), float(fy), float(ppx), float(ppy))
+    intrinsics = rs.intrinsics()
+    intrinsics.width, intrinsics.height = int(width), int(height)
+    intrinsics.fx, intrinsics.fy = float(fx), float(fy)
+    intrinsics.ppx, intrinsics.ppy = float(ppx), float(ppy)
+    intrinsics.model = rs.distortion.none
+    intrinsics.coeffs = [0.0] * 5
+    return intrinsics
+
+
+class PairDirectory:
+    # Lazily decoded (color, z16 depth) pairs of <name>_color<n>.png + <name>_depth_array<n>.npy files.
+    # Only the file names are listed up front, every __getitem__ reads and decodes one frame
+
+    def __init__(self, directory=RECORDING_DIR):
+        self.directory = directory
+        self.paths = []
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.npy') or '_depth_array' not in name:
+                continue
+            color_path = os.path.join(directory, name.replace('_depth_array', '_color').replace('.npy', '.png'))
+            if os.path.exists(color_path):
+                self.paths.append((color_path, os.path.join(directory, name)))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        color_path, depth_path = self.paths[i]
+        depth = np.load(depth_path)
+        if depth.dtype != np.uint16:
+            # Some recordings were saved in meters, bring them back to z16 units
+            depth = np.round(depth / DEPTH_SCALE).astype(np.uint16)
+        return cv2.imread(color_path), depth
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def load_recording(directory=RECORDING_DIR):
+    # Sequence of (color, z16 depth) pairs, decoded lazily: an rgbd_recording.RecordingReader for recordings
+    # with a meta.json, else a PairDirectory of <name>_color<n>.png paired with <name>_depth_array<n>.npy
+    if os.path.exists(os.path.join(directory, 'meta.json')):
+        from rgbd_recording import RecordingReader
+        return RecordingReader(directory)
+    return PairDirectory(directory)
+
+
+def load_intrinsics(directory, width, height):
+    # intrinsics.json ({width, height, fx, fy, ppx, ppy}) next to the recording, else the FOV_PER_PIX pinhole model
+    path = os.path.join(directory, 'intrinsics.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            values = json.load(f)
+        return make_intrinsics(*[values[k] for k in INTRINSICS_FIELDS])
+    return make_intrinsics(*default_intrinsics(width, height))
+
+
+class RecordedProfile:
+    # Enough of rs.video_stream_profile for profile.as_video_stream_profile().intrinsics
+
+    def __init__(self, intrinsics):
+        self.intrinsics = intrinsics
+
+    def as_video_stream_profile(self):
+        return self
+
+    def get_intrinsics(self):
+        return self.intrinsics
+
+
+class RecordedFrame:
+    # One recorded color or depth image behind the rs.frame accessors
+
+    def __init__(self, data, timestamp, number, profile, depth_scale=DEPTH_SCALE):
+        self.data = data
+        self.timestamp = timestamp
+        self.number = number
+        self.profile = profile
+        self.depth_scale = depth_scale
+
+    def __bool__(self):
+        return self.data is not None
+
+    def get_data(self):
+        return self.data
+
+    def get_timestamp(self):  # milliseconds, like librealsense
+        return self.timestamp
+
+    def get_frame_number(self):
+        return self.number
+
+    def get_width(self):
+        return self.data.shape[1]
+
+    def get_height(self):
+        return self.data.shape[0]
+
+    def get_distance(self, x, y):  # meters at pixel (x, y) of a depth frame
+        return float(self.data[y, x]) * self.depth_scale
+
+
+class RecordedFrameset:
+    # A color/depth pair as returned by RecordedSource.wait_for_frames
+
+    def __init__(self, color, depth):
+        self.color = color
+        self.depth = depth
+
+    def get_color_frame(self):
+        return self.color
+
+    def get_depth_frame(self):
+        return self.depth
+
+    def get_timestamp(self):
+        return self.depth.timestamp
+
+    def get_frame_number(self):
+        return self.depth.number
+
+
+class RecordedSource:
+    # Replays recorded (color, depth) pairs. fps paces playback in real time, fps=None plays as fast as
+    # possible. Loops unless loop is False, then wait_for_frames raises EndOfStream (a RuntimeError) at the end
+
+    def __init__(self, frames=None, directory=RECORDING_DIR, fps=30, loop=True, depth_scale=DEPTH_SCALE):
+        frames = load_recording(directory) if frames is None else frames
+        self.frames = frames if hasattr(frames, '__getitem__') else list(frames)
+        if not len(self.frames):
+            raise ValueError('No recorded frames found in %s' % directory)
+        self.fps = fps
+        self.loop = loop
+        self.depth_scale = getattr(self.frames, 'depth_scale', depth_scale)
+        color, depth = self.frames[0]
+        # A RecordingReader carries the intrinsics it was recorded with
+        color_intrinsics = getattr(self.frames, 'color_intrinsics', None)
+        depth_intrinsics = getattr(self.frames, 'depth_intrinsics', None)
+        self.color_intrinsics = make_intrinsics(*[color_intrinsics[k] for k in INTRINSICS_FIELDS]) \
+            if color_intrinsics else load_intrinsics(directory, color.shape[1], color.shape[0])
+        self.depth_intrinsics = make_intrinsics(*[depth_intrinsics[k] for k in INTRINSICS_FIELDS]) \
+            if depth_intrinsics else load_intrinsics(directory, depth.shape[1], depth.shape[0])
+        self._color_profile = RecordedProfile(self.color_intrinsics)
+        self._depth_profile = RecordedProfile(self.depth_intrinsics)
+        self._number = 0
+        self._deadline = None
+
+    def start(self):
+        self._number = 0
+        self._deadline = None
+        return self
+
+    def stop(self):
+        pass
+
+    def get_depth_scale(self):
+        return self.depth_scale
+
+    def wait_for_frames(self, timeout_ms=5000):
+        if self._number >= len(self.frames) and not self.loop:
+            raise EndOfStream('End of recording')
+        if self.fps:
+            now = time.perf_counter()
+            self._deadline = now if self._deadline is None else self._deadline + 1.0 / self.fps
+            if self._deadline > now:
+                time.sleep(self._deadline - now)
+        color, depth = self.frames[self._number % len(self.frames)]
+        timestamp = time.time() * 1000.0
+        self._number += 1
+        return RecordedFrameset(RecordedFrame(color, timestamp, self._number, self._color_profile),
+                                RecordedFrame(depth, timestamp, self._number, self._depth_profile, self.depth_scale))
+
+
+class LiveSource:
+    # A RealSense pipeline whose framesets are aligned to align_to (None: not aligned) by one persistent rs.align
+
+    def __init__(self, config=None, align_to='color'):
+        self.pipeline = rs.pipeline()
+        self.config = config
+        if align_to == 'color':
+            align_to = rs.stream.color
+        self.align = None if align_to is None else rs.align(align_to)
+        self.profile = None
+
+    def start(self):
+        self.profile = self.pipeline.start() if self.config is None else self.pipeline.start(self.config)
+        return self
+
+    def stop(self):
+        self.pipeline.stop()
+
+    def get_depth_scale(self):
+        return self.profile.get_device().first_depth_sensor().get_depth_scale()
+
+    def wait_for_frames(self, timeout_ms=5000):
+        frames = self.pipeline.wait_for_frames(timeout_ms)
+        return frames if self.align is None else self.align.process(frames)
+
+
+def open_source(recording=None, fps=30, config=None, **kwargs):
+    # Started LiveSource when recording is None, else a RecordedSource replaying that directory
+    if recording is None:
+        return LiveSource(config, **kwargs).start()
+    return RecordedSource(directory=recording, fps=fps, **kwargs).start()
+
+
+if __name__ == '__main__':
+    directory = sys.argv[1] if len(sys.argv) > 1 else RECORDING_DIR
+    fps = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    source = open_source(directory, fps=fps or None)
+    start = time.perf_counter()
+    n = 300
+    for _ in range(n):
+        frames = source.wait_for_frames()
+        depth = np.asanyarray(frames.get_depth_frame().get_data())
+        color = np.asanyarray(frames.get_color_frame().get_data())
+    elapsed = time.perf_counter() - start
+    source.stop()
+    print('%d framesets (%dx%d color, %dx%d depth) in %.2fs, %.1f fps' % (
+        n, color.shape[1], color.shape[0], depth.shape[1], depth.shape[0], elapsed, n / elapsed))
@@ -0,0 +1,162 @@
+"""
+Run LoRDE over a recorded dataset on every core
+
+Each worker process opens the dataset itself (an rgbd_recording directory or PNG + .npy pairs like
+calibration_images/), so only frame numbers and ROIs are sent to it. Both kinds are decoded lazily, a
+worker only decodes the frames it is given and counting the frames decodes none. Frames are handed out in
+chunks of --chunksize and every result is written as soon as it finishes, one JSON object per frame
+(.jsonl) or one row per matched box (.csv). In CSV, a frame that failed or matched no box gets one row with
+empty box fields and the error, if any, in the error column.
+
+Usage:
+------
+    python lorde_batch.py <dataset> --roi 340,200,400,310 --output results.jsonl
+    python lorde_batch.py <dataset> --rois rois.csv --output results.csv --workers 8
+                              rois.csv has frame,x1,y1,x2,y2 rows, frames without a row are skipped
+    python lorde_batch.py <dataset> --roi ... --step 10 --profile
+                              every 10th frame, with per-stage timings in the JSONL output
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import utils
+from frame_source import load_intrinsics, load_recording
+
+CSV_FIELDS = ['frame', 'box', 'x1', 'y1', 'x2', 'y2', 'realsense_depth', 'estimated_depth', 'ms', 'error']
+
+_dataset = None
+_intrinsics = None
+
+
+def _open_dataset(path):
+    # Worker initializer, the dataset is opened once per process. Color intrinsics are picked like
+    # RecordedSource does: the recording's own, else intrinsics.json in a PNG + .npy directory, else the
+    # FOV_PER_PIX model at the frame size (which needs the first frame decoded once)
+    global _dataset, _intrinsics
+    _dataset = load_recording(path)
+    _intrinsics = getattr(_dataset, 'color_intrinsics', None)
+    if _intrinsics is None and len(_dataset):
+        height, width = _dataset[0][0].shape[:2]
+        _intrinsics = load_intrinsics(path, width, height)
+
+
+def _float(value):
+    # JSON friendly depth, NaN and None become None
+    return None if value is None or value != value else float(value)
+
+
+def run_frame(job):
+    # lorde_from_roi on one frame of the worker's dataset, as a JSON friendly dict
+    frame, roi, profile = job
+    color, depth = _dataset[frame]
+    start = time.perf_counter()
+    try:
+        out = utils.lorde_from_roi(roi, color, depth, intrinsics=_intrinsics, profile=profile or None)
+    except Exception as e:
+        return {'frame': frame, 'roi': list(roi), 'error': repr(e)}
+    result = {'frame': frame, 'roi': list(roi), 'ms': (time.perf_counter() - start) * 1000,
+              'boxes': [[int(box[0][0]), int(box[0][1]), int(box[1][0]), int(box[1][1])] for box in out['matched_boxes']],
+              'realsense_depth': [_float(realsense) for _, realsense in out['computed_depths']],
+              'estimated_depth': [_float(estimated) for estimated, _ in out['computed_depths']],
+              'pid': os.getpid()}
+    if profile:
+        result['profile'] = out['profile'].to_dict()
+    return result
+
+
+def load_rois(path):
+    # {frame: (x1, y1, x2, y2)} from a CSV with frame,x1,y1,x2,y2 columns
+    with open(path) as f:
+        return {int(row['frame']): tuple(int(row[k]) for k in ('x1', 'y1', 'x2', 'y2')) for row in csv.DictReader(f)}
+
+
+def make_jobs(num_frames, roi=None, rois=None, start=0, stop=None, step=1, profile=False):
+    for frame in range(*slice(start, stop, step).indices(num_frames)):
+        frame_roi = rois.get(frame) if rois is not None else roi
+        if frame_roi is not None:
+            yield (frame, frame_roi, profile)
+
+
+class ResultWriter:
+    # Streams results to a .jsonl or .csv file (or JSONL on stdout), flushing after every frame
+
+    def __init__(self, path=None):
+        self.file = sys.stdout if path is None else open(path, 'w', newline='')
+        self.csv = None
+        if path is not None and path.endswith('.csv'):
+            self.csv = csv.DictWriter(self.file, CSV_FIELDS)
+            self.csv.writeheader()
+
+    def write(self, result):
+        if self.csv is None:
+            self.file.write(json.dumps(result) + '\n')
+        elif not result.get('boxes'):
+            # One row for a frame that failed or matched nothing, so it still shows up in the CSV
+            self.csv.writerow({'frame': result['frame'], 'error': result.get('error', ''),
+                               'ms': '%.2f' % result['ms'] if 'ms' in result else ''})
+        else:
+            for i, box in enumerate(result['boxes']):
+                self.csv.writerow({'frame': result['frame'], 'box': i, 'x1': box[0], 'y1': box[1], 'x2': box[2],
+                                   'y2': box[3], 'realsense_depth': result['realsense_depth'][i],
+                                   'estimated_depth': result['estimated_depth'][i], 'ms': '%.2f' % result['ms']})
+        self.file.flush()
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+def run(dataset, jobs, writer, workers=None, chunksize=4, ordered=False):
+    # Fan jobs out over a process pool and write results as they arrive, returns (frames, errors)
+    frames = errors = 0
+    with multiprocessing.Pool(workers, initializer=_open_dataset, initargs=(dataset,)) as pool:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for result in imap(run_frame, jobs, chunksize):
+            writer.write(result)
+            frames += 1
+            errors += 'error' in result
+    return frames, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run lorde_from_roi over a recorded RGB-D dataset')
+    parser.add_argument('dataset', help='rgbd_recording directory or a directory of PNG + .npy pairs')
+    parser.add_argument('--roi', help='x1,y1,x2,y2 used for every frame')
+    parser.add_argument('--rois', help='CSV of frame,x1,y1,x2,y2 rows, one ROI per frame')
+    parser.add_argument('--output', help='.jsonl or .csv file to write, JSONL on stdout by default')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: every core)')
+    parser.add_argument('--chunksize', type=int, default=4, help='frames handed to a worker at a time')
+    parser.add_argument('--start', type=int, default=0)
+    parser.add_argument('--stop', type=int, default=None)
+    parser.add_argument('--step', type=int, default=1, help='only every step-th frame')
+    parser.add_argument('--ordered', action='store_true', help='write results in frame order')
+    parser.add_argument('--profile', action='store_true', help='add per-stage timings to the JSONL results')
+    args = parser.parse_args(argv)
+    if (args.roi is None) == (args.rois is None):
+        parser.error('give exactly one of --roi and --rois')
+
+    roi = tuple(int(v) for v in args.roi.split(',')) if args.roi else None
+    rois = load_rois(args.rois) if args.rois else None
+    num_frames = len(load_recording(args.dataset))
+    jobs = make_jobs(num_frames, roi, rois, args.start, args.stop, args.step, args.profile)
+
+    writer = ResultWriter(args.output)
+    start = time.perf_counter()
+    try:
+        frames, errors = run(args.dataset, jobs, writer, args.workers, args.chunksize, args.ordered)
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+    sys.stderr.write('%d frames (%d errors) in %.2fs, %.2f frames/s with %d workers\n' % (
+        frames, errors, elapsed, frames / elapsed if elapsed else 0.0, args.workers or os.cpu_count()))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+"""
+LoRDE in a worker process so ROI analysis never blocks the UI
+
+LordeWorker.submit copies the color and depth frames once into shared memory and sends only
+their names and shapes to a process pool worker, which runs utils.lorde_from_roi on zero-copy
+views. Only the newest ROI matters: one request runs at a time, a submission made meanwhile waits in
+this process and replaces any older waiting one, and results of superseded requests are dropped. Finished results are queued for the UI thread, which
+collects them with poll() (e.g. from a Tk after() loop) since Tk must not be called from other threads.
+
+Usage:
+------
+    python lorde_worker.py     Submit three ROIs on cone_color2 at once and print the newest result
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class SharedFrame:
+    # A numpy array copied into a shared memory block, pickles as (name, shape, dtype) only
+
+    def __init__(self, array):
+        array = np.ascontiguousarray(array)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.spec = (self.shm.name, array.shape, array.dtype.str)
+        np.ndarray(array.shape, array.dtype, buffer=self.shm.buf)[...] = array
+
+    def release(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _attach(spec):
+    # (SharedMemory, array view) for a SharedFrame.spec in the worker process
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+
+
+def _run_lorde(roi_coords, color_spec, depth_spec, intrinsics=None):
+    # Worker side: run lorde_from_roi on views of the shared frames, plain python results only
+    from utils import lorde_from_roi
+    color_shm, color = _attach(color_spec)
+    depth_shm, depth = _attach(depth_spec)
+    try:
+        out = lorde_from_roi(roi_coords, color, depth, intrinsics=intrinsics)
+    finally:
+        del color, depth  # views must go before the blocks are closed
+        color_shm.close()
+        depth_shm.close()
+    return {'matched_boxes': [tuple(tuple(int(v) for v in p) for p in box) for box in out['matched_boxes']],
+            'computed_depths': [tuple(None if d is None else float(d) for d in pair) for pair in out['computed_depths']]}
+
+
+class LordeWorker:
+    # Process pool running one LoRDE request at a time, the newest submission wins. While a request runs, the
+    # newest one waits in this process and replaces any older waiting one, so superseded requests never reach
+    # the pool (a ProcessPoolExecutor moves queued calls to its workers early, where they can't be cancelled)
+
+    def __init__(self, max_workers=1):
+        # spawn, not Linux's default fork: the pool starts on the first submit, when the librealsense
+        # pipeline and Tk are already running in this process and must not be copied into the worker
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+        self.results = queue.Queue()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._running = False
+        self._waiting = None  # newest request submitted while another was running
+        self._closed = False
+        self.started = 0  # requests sent to the pool
+
+    def submit(self, roi_coords, color, depth, intrinsics=None, context=None):
+        # Run lorde_from_roi(roi_coords, color, depth) in the worker; context (e.g. the frame to draw on) comes
+        # back with poll(). The frames are copied now, the caller may reuse them
+        if intrinsics is not None:
+            # A plain tuple pickles to the worker, rs.intrinsics does not
+            from utils import intrinsics_key
+            intrinsics = intrinsics_key(intrinsics)
+        frames = (SharedFrame(color), SharedFrame(depth))
+        with self._lock:
+            self._generation += 1
+            request = (self._generation, tuple(roi_coords), frames, intrinsics, context)
+            stale = None
+            if self._running:
+                stale, self._waiting, request = self._waiting, request, None
+            else:
+                self._running = True
+        if stale is not None:
+            _release(stale)
+        if request is not None:
+            self._start(request)
+
+    def _start(self, request):
+        # Send a request to the pool, its callback starts the waiting one
+        _, roi_coords, frames, intrinsics, _ = request
+        try:
+            future = self.executor.submit(_run_lorde, roi_coords, frames[0].spec, frames[1].spec, intrinsics)
+        except RuntimeError:  # shut down
+            _release(request)
+            with self._lock:
+                self._running = False
+            return
+        self.started += 1
+        future.add_done_callback(lambda f: self._done(f, request))
+
+    def _done(self, future, request):
+        # Runs on the executor's thread: free the shared frames, queue the result if it is still the newest
+        # request and start the one that waited for it
+        _release(request)
+        generation, roi_coords, _, _, context = request
+        with self._lock:
+            newest = generation == self._generation
+            waiting, self._waiting = self._waiting, None
+            self._running = waiting is not None and not self._closed
+        if newest and not future.cancelled():
+            try:
+                result = future.result()
+            except Exception as e:
+                result = e
+            self.results.put((roi_coords, result, context))
+        if waiting is not None:
+            if self._running:
+                self._start(waiting)
+            else:
+                _release(waiting)
+
+    def poll(self):
+        # (roi_coords, result or exception, context) of the newest finished request, or None. Call from the UI thread
+        latest = None
+        while True:
+            try:
+                latest = self.results.get_nowait()
+            except queue.Empty:
+                return latest
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            waiting, self._waiting = self._waiting, None
+        if waiting is not None:
+            _release(waiting)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _release(request):
+    for frame in request[2]:
+        frame.release()
+
+
+if __name__ == '__main__':
+    import cv2
+    color = cv2.imread(os.path.join(HERE, 'calibration_images', 'cone_color2.png'))
+    depth = np.load(os.path.join(HERE, 'calibration_images', 'cone_depth_array2.npy'))  # z16
+    worker = LordeWorker()
+    start = time.perf_counter()
+    for roi in [(300, 180, 420, 330), (320, 190, 410, 320), (340, 200, 400, 310)]:
+        worker.submit(roi, color, depth)
+    print('submitted in %.1f ms' % ((time.perf_counter() - start) * 1000))
+    result = None
+    while result is None:
+        time.sleep(0.05)
+        result = worker.poll()
+    print('finished in %.2fs, requests sent to the pool: %d of 3' % (time.perf_counter() - start, worker.started))
+    print(result[0], result[1])
+    worker.shutdown()
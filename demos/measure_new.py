@@ -2,31 +2,31 @@ import pyrealsense2 as rs
 import numpy as np
 import cv2
 import copy
-import math
+import sys
 
-class ARC:
-    def __init__(self):
-        #bag = r'0626_005.bag'
-        self.pipeline = rs.pipeline()
+from frame_source import LiveSource, RecordedSource
+from utils import deproject_points
 
-        config = rs.config()
-        #config.enable_device_from_file(bag, False)
-        #config.enable_all_streams()
+class ARC:
+    def __init__(self, source=None):  # source: frame_source to read from, a .bag playback by default
+        if source is None:
+            #bag = r'0626_005.bag'
+            config = rs.config()
+            #config.enable_device_from_file(bag, False)
+            #config.enable_all_streams()
 
-        profile = self.pipeline.start(config)
-        device = profile.get_device()
-        playback = device.as_playback()
-        playback.set_real_time(False)
+            source = LiveSource(config).start()  # depth aligned to color
+            device = source.profile.get_device()
+            playback = device.as_playback()
+            playback.set_real_time(False)
+        self.source = source
 
 
     def video(self):
-        align_to = rs.stream.color
-        align = rs.align(align_to)
         for i in range(10):
-            self.pipeline.wait_for_frames()
+            self.source.wait_for_frames()
         while True:
-            frames = self.pipeline.wait_for_frames()
-            aligned_frames = align.process(frames)
+            aligned_frames = self.source.wait_for_frames()
             color_frame = aligned_frames.get_color_frame()
             depth_frame = aligned_frames.get_depth_frame()
 
@@ -35,10 +35,7 @@ class ARC:
             color_image = np.asanyarray(color_frame.get_data())
             self.color_intrin = color_frame.profile.as_video_stream_profile().intrinsics
 
-            depth_color_frame = rs.colorizer().colorize(depth_frame)
-
-            # Convert depth_frame to numpy array to render image in opencv
-            depth_color_image = np.asanyarray(depth_color_frame.get_data())
+            # Convert color_frame to numpy array to render image in opencv
             color_image = np.asanyarray(color_frame.get_data())
             color_cvt = cv2.cvtColor(color_image, cv2.COLOR_BGR2RGB)
             self.show(color_cvt)
@@ -95,16 +92,15 @@ class ARC:
         vdist = self.depth_frame.get_distance(x, y)
         #print udist,vdist
 
-        point1 = rs.rs2_deproject_pixel_to_point(color_intrin, [ix, iy], udist)
-        point2 = rs.rs2_deproject_pixel_to_point(color_intrin, [x, y], vdist)
+        # Both pixels in one call, undistorted by librealsense when the color intrinsics have distortion coeffs
+        point1, point2 = deproject_points(color_intrin, [[ix, iy], [x, y]], [udist, vdist])
         #print str(point1)+str(point2)
 
-        dist = math.sqrt(
-            math.pow(point1[0] - point2[0], 2) + math.pow(point1[1] - point2[1],2) + math.pow(
-                point1[2] - point2[2], 2))
+        dist = float(np.linalg.norm(point1 - point2))
         #print 'distance: '+ str(dist)
         return dist
 
 
 if __name__ == '__main__':
-    ARC().video()
+    # python measure_new.py [recording_dir] measures on a recorded directory instead of the bag
+    ARC(RecordedSource(directory=sys.argv[1], fps=None).start() if len(sys.argv) > 1 else None).video()
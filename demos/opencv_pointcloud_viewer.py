@@ -18,6 +18,7 @@ Keyboard:
     [p]     Pause
     [r]     Reset View
     [d]     Cycle through decimation values
+    [v]     Cycle through voxel downsampling sizes (off, 5 mm, 1 cm, 2 cm)
     [z]     Toggle point scaling
     [c]     Toggle color source
     [s]     Save PNG (./out.png)
@@ -31,6 +32,10 @@ import cv2
 import numpy as np
 import pyrealsense2 as rs
 
+from frame_source import LiveSource
+from colorize import DepthColorizer
+import pointcloud_render
+
 class AppState:
 
     def __init__(self, *args, **kwargs):
@@ -42,6 +47,7 @@ class AppState:
         self.mouse_btns = [False, False, False]
         self.paused = False
         self.decimate = 1
+        self.voxel = 0  # voxel downsampling leaf size in meters, 0: off
         self.scale = True
         self.color = True
 
@@ -62,11 +68,11 @@ class AppState:
 
 state = AppState()
 
-# Configure depth and color streams
-pipeline = rs.pipeline()
+# Configure depth and color streams, the point cloud maps color itself so frames are not aligned
 config = rs.config()
+source = LiveSource(config, align_to=None)
 
-pipeline_wrapper = rs.pipeline_wrapper(pipeline)
+pipeline_wrapper = rs.pipeline_wrapper(source.pipeline)
 pipeline_profile = config.resolve(pipeline_wrapper)
 device = pipeline_profile.get_device()
 
@@ -83,10 +89,10 @@ config.enable_stream(rs.stream.depth, rs.format.z16, 30)
 config.enable_stream(rs.stream.color, rs.format.bgr8, 30)
 
 # Start streaming
-pipeline.start(config)
+source.start()
 
 # Get stream profile and camera intrinsics
-profile = pipeline.get_active_profile()
+profile = source.profile
 depth_profile = rs.video_stream_profile(profile.get_stream(rs.stream.depth))
 depth_intrinsics = depth_profile.get_intrinsics()
 w, h = depth_intrinsics.width, depth_intrinsics.height
@@ -95,7 +101,10 @@ w, h = depth_intrinsics.width, depth_intrinsics.height
 pc = rs.pointcloud()
 decimate = rs.decimation_filter()
 decimate.set_option(rs.option.filter_magnitude, 2 ** state.decimate)
-colorizer = rs.colorizer()
+colorizer = DepthColorizer()
+depth_colormap = None
+zbuffer = pointcloud_render.ZBuffer()
+overlay = pointcloud_render.CachedLayer()
 
 
 def mouse_cb(event, x, y, flags, param):
@@ -151,18 +160,7 @@ cv2.setMouseCallback(state.WIN_NAME, mouse_cb)
 
 def project(v):
     """project 3d vector array to 2d"""
-    h, w = out.shape[:2]
-    view_aspect = float(h)/w
-
-    # ignore divide by zero for invalid depth
-    with np.errstate(divide='ignore', invalid='ignore'):
-        proj = v[:, :-1] / v[:, -1, np.newaxis] * \
-            (w*view_aspect, h) + (w/2.0, h/2.0)
-
-    # near clipping
-    znear = 0.03
-    proj[v[:, 2] < znear] = np.nan
-    return proj
+    return pointcloud_render.project(v, out.shape)
 
 
 def view(v):
@@ -170,107 +168,84 @@ def view(v):
     return np.dot(v - state.pivot, state.rotation) + state.pivot - state.translation
 
 
+def lines3d(out, segments, color=(0x80, 0x80, 0x80), thickness=1):
+    """draw (N, 2, 3) view-space segments, projected together and drawn with one polylines call"""
+    pointcloud_render.draw_segments(out, segments, color, thickness)
+
+
 def line3d(out, pt1, pt2, color=(0x80, 0x80, 0x80), thickness=1):
     """draw a 3d line from pt1 to pt2"""
-    p0 = project(pt1.reshape(-1, 3))[0]
-    p1 = project(pt2.reshape(-1, 3))[0]
-    if np.isnan(p0).any() or np.isnan(p1).any():
-        return
-    p0 = tuple(p0.astype(int))
-    p1 = tuple(p1.astype(int))
-    rect = (0, 0, out.shape[1], out.shape[0])
-    inside, p0, p1 = cv2.clipLine(rect, p0, p1)
-    if inside:
-        cv2.line(out, p0, p1, color, thickness, cv2.LINE_AA)
+    lines3d(out, np.stack([np.reshape(pt1, 3), np.reshape(pt2, 3)])[np.newaxis], color, thickness)
 
 
 def grid(out, pos, rotation=np.eye(3), size=1, n=10, color=(0x80, 0x80, 0x80)):
     """draw a grid on xz plane"""
-    pos = np.array(pos)
-    s = size / float(n)
     s2 = 0.5 * size
-    for i in range(0, n+1):
-        x = -s2 + i*s
-        line3d(out, view(pos + np.dot((x, 0, -s2), rotation)),
-               view(pos + np.dot((x, 0, s2), rotation)), color)
-    for i in range(0, n+1):
-        z = -s2 + i*s
-        line3d(out, view(pos + np.dot((-s2, 0, z), rotation)),
-               view(pos + np.dot((s2, 0, z), rotation)), color)
+    t = -s2 + np.arange(n + 1) * (size / float(n))
+    # lines along z at every x, then along x at every z, as (2 * (n + 1), 2, 3) endpoints
+    ends = np.zeros((2, n + 1, 2, 3))
+    ends[0, :, :, 0] = t[:, np.newaxis]
+    ends[0, :, :, 2] = (-s2, s2)
+    ends[1, :, :, 0] = (-s2, s2)
+    ends[1, :, :, 2] = t[:, np.newaxis]
+    points = np.array(pos) + np.dot(ends.reshape(-1, 3), rotation)
+    lines3d(out, view(points).reshape(-1, 2, 3), color)
 
 
 def axes(out, pos, rotation=np.eye(3), size=0.075, thickness=2):
     """draw 3d axes"""
-    line3d(out, pos, pos +
-           np.dot((0, 0, size), rotation), (0xff, 0, 0), thickness)
-    line3d(out, pos, pos +
-           np.dot((0, size, 0), rotation), (0, 0xff, 0), thickness)
-    line3d(out, pos, pos +
-           np.dot((size, 0, 0), rotation), (0, 0, 0xff), thickness)
+    tips = pos + np.dot(np.eye(3)[::-1] * size, rotation)  # z, y, x
+    for tip, color in zip(tips, [(0xff, 0, 0), (0, 0xff, 0), (0, 0, 0xff)]):
+        line3d(out, pos, tip, color, thickness)
 
 
 def frustum(out, intrinsics, color=(0x40, 0x40, 0x40)):
     """draw camera's frustum"""
-    orig = view([0, 0, 0])
     w, h = intrinsics.width, intrinsics.height
 
-    for d in range(1, 6, 2):
-        def get_point(x, y):
-            p = rs.rs2_deproject_pixel_to_point(intrinsics, [x, y], d)
-            line3d(out, orig, view(p), color)
-            return p
+    # corners top left, top right, bottom right, bottom left deprojected at 1, 3 and 5 m
+    # (rs.rs2_deproject_pixel_to_point of the undistorted depth stream)
+    x = (np.array([0, w, w, 0]) - intrinsics.ppx) / intrinsics.fx
+    y = (np.array([0, 0, h, h]) - intrinsics.ppy) / intrinsics.fy
+    d = np.array([1, 3, 5])[:, np.newaxis]
+    corners = view(np.stack([x * d, y * d, np.broadcast_to(d, (3, 4))], axis=-1).reshape(-1, 3)).reshape(3, 4, 3)
+
+    # rays from the camera to every corner, and the rectangle of each distance
+    orig = np.broadcast_to(view([0, 0, 0]), corners.shape)
+    edges = np.stack([corners, np.roll(corners, -1, axis=1)], axis=2)
+    rays = np.stack([orig, corners], axis=2)
+    lines3d(out, np.concatenate([rays.reshape(-1, 2, 3), edges.reshape(-1, 2, 3)]), color)
 
-        top_left = get_point(0, 0)
-        top_right = get_point(w, 0)
-        bottom_right = get_point(w, h)
-        bottom_left = get_point(0, h)
 
-        line3d(out, view(top_left), view(top_right), color)
-        line3d(out, view(top_right), view(bottom_right), color)
-        line3d(out, view(bottom_right), view(bottom_left), color)
-        line3d(out, view(bottom_left), view(top_left), color)
+def pointcloud(out, verts, texcoords, color, painter=False):
+    """draw point cloud, nearest point per pixel by z-buffer or optionally the painter's algorithm"""
+    v = view(verts)
+    proj = project(v)
 
+    if state.scale:
+        proj *= 0.5**state.decimate
 
-def pointcloud(out, verts, texcoords, color, painter=True):
-    """draw point cloud with optional painter's algorithm"""
+    # proj now contains 2d image coordinates
     if painter:
         # Painter's algo, sort points from back to front
-
-        # get reverse sorted indices by z (in view-space)
         # https://gist.github.com/stevenvo/e3dad127598842459b68
-        v = view(verts)
-        s = v[:, 2].argsort()[::-1]
-        proj = project(v[s])
+        pointcloud_render.painter(out, proj, v[:, 2], texcoords, color)
     else:
-        proj = project(view(verts))
+        zbuffer.splat(out, proj, v[:, 2], texcoords, color)
 
-    if state.scale:
-        proj *= 0.5**state.decimate
-
-    h, w = out.shape[:2]
 
-    # proj now contains 2d image coordinates
-    j, i = proj.astype(np.uint32).T
+def draw_static(out):
+    """draw the grid, camera frustum and origin axes"""
+    grid(out, (0, 0.5, 1), size=1, n=10)
+    frustum(out, depth_intrinsics)
+    axes(out, view([0, 0, 0]), state.rotation, size=0.1, thickness=1)
 
-    # create a mask to ignore out-of-bound indices
-    im = (i >= 0) & (i < h)
-    jm = (j >= 0) & (j < w)
-    m = im & jm
 
-    cw, ch = color.shape[:2][::-1]
-    if painter:
-        # sort texcoord with same indices as above
-        # texcoords are [0..1] and relative to top-left pixel corner,
-        # multiply by size and add 0.5 to center
-        v, u = (texcoords[s] * (cw, ch) + 0.5).astype(np.uint32).T
-    else:
-        v, u = (texcoords * (cw, ch) + 0.5).astype(np.uint32).T
-    # clip texcoords to image
-    np.clip(u, 0, ch-1, out=u)
-    np.clip(v, 0, cw-1, out=v)
-
-    # perform uv-mapping
-    out[i[m], j[m]] = color[u[m], v[m]]
+def static_key():
+    """everything draw_static depends on, the cached overlay is redrawn when it changes"""
+    i = depth_intrinsics
+    return (state.pitch, state.yaw, tuple(state.translation), state.distance,
+            (i.width, i.height, i.fx, i.fy, i.ppx, i.ppy))
 
 
 out = np.empty((h, w, 3), dtype=np.uint8)
@@ -279,7 +254,7 @@ while True:
     # Grab camera data
     if not state.paused:
         # Wait for a coherent pair of frames: depth and color
-        frames = pipeline.wait_for_frames()
+        frames = source.wait_for_frames()
 
         depth_frame = frames.get_depth_frame()
         color_frame = frames.get_color_frame()
@@ -294,12 +269,11 @@ while True:
         depth_image = np.asanyarray(depth_frame.get_data())
         color_image = np.asanyarray(color_frame.get_data())
 
-        depth_colormap = np.asanyarray(
-            colorizer.colorize(depth_frame).get_data())
-
         if state.color:
             mapped_frame, color_source = color_frame, color_image
         else:
+            # Depth texture, only colorized while it is shown
+            depth_colormap = colorizer.colorize(depth_image, out=depth_colormap)
             mapped_frame, color_source = depth_frame, depth_colormap
 
         points = pc.calculate(depth_frame)
@@ -310,14 +284,15 @@ while True:
         verts = np.asanyarray(v).view(np.float32).reshape(-1, 3)  # xyz
         texcoords = np.asanyarray(t).view(np.float32).reshape(-1, 2)  # uv
 
+        if state.voxel:
+            # One averaged point per occupied voxel, uniform density near and far
+            verts, texcoords = pointcloud_render.voxel_downsample(verts, texcoords, state.voxel)
+
     # Render
     now = time.time()
 
-    out.fill(0)
-
-    grid(out, (0, 0.5, 1), size=1, n=10)
-    frustum(out, depth_intrinsics)
-    axes(out, view([0, 0, 0]), state.rotation, size=0.1, thickness=1)
+    # Start from the static overlay, only redrawn when the view or the intrinsics changed
+    np.copyto(out, overlay.get(static_key(), out.shape, draw_static))
 
     if not state.scale or out.shape[:2] == (h, w):
         pointcloud(out, verts, texcoords, color_source)
@@ -350,6 +325,10 @@ while True:
         state.decimate = (state.decimate + 1) % 3
         decimate.set_option(rs.option.filter_magnitude, 2 ** state.decimate)
 
+    if key == ord("v"):
+        voxel_sizes = [0, 0.005, 0.01, 0.02]
+        state.voxel = voxel_sizes[(voxel_sizes.index(state.voxel) + 1) % len(voxel_sizes)]
+
     if key == ord("z"):
         state.scale ^= True
 
@@ -366,4 +345,4 @@ while True:
     #    break
 
 # Stop streaming
-pipeline.stop()
+source.stop()
@@ -0,0 +1,242 @@
+"""
+Point splatting and point reduction for the OpenCV point cloud viewer
+
+ZBuffer draws projected points keeping the nearest one per pixel. It builds one int64 key per point
+from the view-space depth (the bit pattern of a positive float32 sorts like the float) and the point
+index, and takes the minimum key per pixel with a scatter-min on the linear pixel index.
+Only the winning points are looked up in the texture. This is O(n), while the painter's algorithm
+argsorts every point back to front and then draws them all. Both draw the same image, except that
+the painter also drew points behind the near plane into pixel (0, 0), because NaN casts to 0, and
+breaks ties between points at the same depth in a pixel in any order (the z-buffer draws the lowest
+index, like the painter with a stable sort).
+
+voxel_downsample replaces every occupied voxel of a leaf size in meters by the average of its points
+(XYZ and texture coordinates), so the density is the same near and far, unlike decimation in image space.
+
+Usage:
+------
+    python pointcloud_render.py     Compare the painter and the z-buffer on the recorded cone depth, and time
+                                    voxel downsampling
+"""
+
+import math
+import os
+import timeit
+import cv2
+import numpy as np
+
+from frame_source import load_intrinsics
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def project(v, shape, znear=0.03):
+    """project (N, 3) view-space points to (N, 2) pixels of an image of shape, NaN behind znear"""
+    h, w = shape[:2]
+    view_aspect = float(h) / w
+
+    # ignore divide by zero for invalid depth
+    with np.errstate(divide='ignore', invalid='ignore'):
+        proj = v[:, :-1] / v[:, -1, np.newaxis] * (w * view_aspect, h) + (w / 2.0, h / 2.0)
+
+    # near clipping
+    proj[v[:, 2] < znear] = np.nan
+    return proj
+
+
+def texture_indices(texcoords, color):
+    """(row, column) of the color pixel under each [0..1] texcoord"""
+    # texcoords are relative to the top-left pixel corner, multiply by size and add 0.5 to center
+    ch, cw = color.shape[:2]
+    v, u = (texcoords * (cw, ch) + 0.5).astype(np.uint32).T
+    np.clip(u, 0, ch - 1, out=u)
+    np.clip(v, 0, cw - 1, out=v)
+    return u, v
+
+
+def painter(out, proj, z, texcoords, color, kind='quicksort'):
+    """draw points back to front, so the nearest point of each pixel is drawn last"""
+    # Points at equal depth are drawn in any order unless kind='stable', then the lowest index is drawn last
+    s = z.argsort(kind=kind)[::-1]
+    j, i = proj[s].astype(np.uint32).T
+
+    # mask out-of-bound indices
+    h, w = out.shape[:2]
+    m = (i >= 0) & (i < h) & (j >= 0) & (j < w)
+
+    u, v = texture_indices(texcoords[s], color)
+    out[i[m], j[m]] = color[u[m], v[m]]
+
+
+class ZBuffer:
+    # Depth-tested point splatting into reused per-pixel buffers
+
+    EMPTY = np.iinfo(np.int64).max
+
+    def __init__(self):
+        self._keys = None
+
+    def nearest(self, proj, z, shape):
+        """(pixels, points): linear pixel index of every covered pixel and the index of its nearest point"""
+        h, w = shape[:2]
+        if self._keys is None or self._keys.size != h * w:
+            self._keys = np.empty(h * w, dtype=np.int64)
+        self._keys.fill(self.EMPTY)
+
+        # NaN fails every comparison. Pixels are truncated like the painter's uint32 cast, so points
+        # less than a pixel left of or above the image land in column or row 0
+        x, y = proj.T
+        points = np.flatnonzero((x > -1) & (x < w) & (y > -1) & (y < h))
+        j, i = proj[points].astype(np.int64).T
+        # z is positive past the near plane, where its float32 bits sort like the value
+        keys = z[points].astype(np.float32).view(np.int32).astype(np.int64) << 32
+        keys |= points
+        np.minimum.at(self._keys, i * w + j, keys)
+
+        pixels = np.flatnonzero(self._keys != self.EMPTY)
+        return pixels, self._keys[pixels] & 0xffffffff
+
+    def splat(self, out, proj, z, texcoords, color):
+        """draw the nearest point of every pixel, one texture lookup per covered pixel"""
+        pixels, points = self.nearest(proj, z, out.shape)
+        u, v = texture_indices(texcoords[points], color)
+        out.reshape(-1, out.shape[2])[pixels] = color[u, v]
+
+
+def clip_segments(p, width, height):
+    """(N, 2, 2) integer segments clipped to the image like cv2.clipLine, and the mask of visible ones"""
+    # Liang-Barsky on every segment at once, t in [t0, t1] is the visible part of p[:, 0] + t * d
+    p = p.astype(np.float64)
+    d = p[:, 1] - p[:, 0]
+    t0 = np.zeros(len(p))
+    t1 = np.ones(len(p))
+    visible = np.ones(len(p), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for axis, hi in ((0, width - 1), (1, height - 1)):
+            for step, room in ((-d[:, axis], p[:, 0, axis]), (d[:, axis], hi - p[:, 0, axis])):
+                visible &= (step != 0) | (room >= 0)
+                r = room / step
+                t0 = np.where(step < 0, np.maximum(t0, r), t0)
+                t1 = np.where(step > 0, np.minimum(t1, r), t1)
+    visible &= t0 <= t1
+    clipped = p[:, :1] + np.stack([t0, t1], axis=1)[:, :, None] * d[:, None]
+    return np.round(clipped).astype(np.int32), visible
+
+
+def draw_segments(out, segments, color=(0x80, 0x80, 0x80), thickness=1, znear=0.03):
+    """draw (N, 2, 3) view-space segments: one projection for every endpoint and one polylines call"""
+    segments = np.asarray(segments, dtype=np.float64).reshape(-1, 2, 3)
+    proj = project(segments.reshape(-1, 3), out.shape, znear).reshape(-1, 2, 2)
+
+    # drop segments with an endpoint behind the near plane (NaN) or invalid, then clip to the image
+    proj = proj[np.isfinite(proj).all(axis=(1, 2))]
+    h, w = out.shape[:2]
+    lines, visible = clip_segments(proj.astype(np.int64), w, h)
+    if visible.any():
+        cv2.polylines(out, lines[visible], False, color, thickness, cv2.LINE_AA)
+
+
+def voxel_downsample(verts, texcoords, leaf_size=0.01):
+    """one point per occupied leaf_size (meters) voxel: the mean XYZ and mean UV of the points inside it"""
+    # Invalid depth deprojects to the origin, those points are dropped
+    keep = verts[:, 2] > 0
+    verts, texcoords = verts[keep], texcoords[keep]
+    if not len(verts):
+        return verts, texcoords
+
+    # Linear voxel index, built one column at a time (reductions over (N, 3) rows are slow in NumPy)
+    keys = np.zeros(len(verts), dtype=np.int64)
+    for axis in range(3):
+        cell = np.floor(verts[:, axis] * (1.0 / leaf_size)).astype(np.int64)
+        low = cell.min()
+        keys *= cell.max() - low + 1
+        keys += cell
+        keys -= low
+
+    # np.unique sorts the keys and numbers the occupied voxels, the means are per-voxel sums over counts
+    voxels, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(voxels))
+    points = np.empty((len(voxels), 5), dtype=np.float32)
+    for i, column in enumerate([verts[:, 0], verts[:, 1], verts[:, 2], texcoords[:, 0], texcoords[:, 1]]):
+        points[:, i] = np.bincount(inverse, weights=column, minlength=len(voxels)) / counts
+    return points[:, :3], points[:, 3:]
+
+
+class CachedLayer:
+    # An image redrawn only when its key changes, for overlays that depend on the view but not the frame
+
+    def __init__(self):
+        self.key = None
+        self.image = None
+
+    def get(self, key, shape, draw):
+        # The layer of shape, calling draw(image) on a cleared image first when key or shape changed
+        if self.image is None or self.image.shape != shape:
+            self.image = np.zeros(shape, dtype=np.uint8)
+            self.key = None
+        if key != self.key:
+            self.image.fill(0)
+            draw(self.image)
+            self.key = key
+        return self.image
+
+
+def view_matrix(pitch, yaw):
+    Rx, _ = cv2.Rodrigues((pitch, 0, 0))
+    Ry, _ = cv2.Rodrigues((0, yaw, 0))
+    return np.dot(Ry, Rx).astype(np.float32)
+
+
+if __name__ == '__main__':
+    from utils import ray_table
+
+    # Recorded vertices: the cone depth deprojected with the pinhole model, texture aligned to the depth
+    color = cv2.imread(os.path.join(HERE, 'calibration_images', 'cone_color2.png'))
+    depth = np.load(os.path.join(HERE, 'calibration_images', 'cone_depth_array2.npy'))
+    zbuffer = ZBuffer()
+    for size in [(640, 480), (1280, 720)]:
+        d = cv2.resize(depth, size, interpolation=cv2.INTER_NEAREST)
+        c = cv2.resize(color, size)
+        table = ray_table(load_intrinsics(os.path.join(HERE, 'calibration_images'), *size))
+        verts = table.deproject(d).reshape(-1, 3)
+        texcoords = table.texcoords
+
+        # The viewer's initial view
+        rotation = view_matrix(math.radians(-10), math.radians(-15))
+        translation = np.array([0, 0, -1], dtype=np.float32)
+        pivot = translation + np.array((0, 0, 2), dtype=np.float32)
+        v = np.dot(verts - pivot, rotation) + pivot - translation
+
+        painted = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+        splatted = np.zeros_like(painted)
+
+        def paint():
+            painted.fill(0)
+            painter(painted, project(v, painted.shape), v[:, 2], texcoords, c)
+
+        def splat():
+            splatted.fill(0)
+            zbuffer.splat(splatted, project(v, splatted.shape), v[:, 2], texcoords, c)
+
+        splat()
+        differ = []
+        for kind in ['quicksort', 'stable']:
+            painted.fill(0)
+            painter(painted, project(v, painted.shape), v[:, 2], texcoords, c, kind)
+            d = (painted != splatted).any(axis=2)
+            d[0, 0] = False  # the painter's NaN points
+            differ.append(d.sum())
+        print('%dx%d: %d points, %d pixels drawn, differ from the painter outside pixel (0, 0): %d, %d with a stable sort' % (
+            size[0], size[1], len(verts), (splatted != 0).any(axis=2).sum(), differ[0], differ[1]))
+        for name, fn in [('painter', paint), ('z-buffer', splat)]:
+            ms = min(timeit.repeat(fn, number=10, repeat=5)) / 10 * 1000
+            print('    %-8s %6.2f ms  %5.1f fps' % (name, ms, 1000 / ms))
+
+        for leaf_size in [0.005, 0.01, 0.02]:
+            voxels, uv = voxel_downsample(verts, texcoords, leaf_size)
+            v = np.dot(voxels - pivot, rotation) + pivot - translation
+            ms = min(timeit.repeat(lambda: voxel_downsample(verts, texcoords, leaf_size), number=5, repeat=3)) / 5 * 1000
+            render_ms = min(timeit.repeat(lambda: zbuffer.splat(splatted, project(v, splatted.shape), v[:, 2], uv, c),
+                                          number=10, repeat=3)) / 10 * 1000
+            print('    %.3f m voxels: %6d points, downsample %6.2f ms, z-buffer %6.2f ms' % (
+                leaf_size, len(voxels), ms, render_ms))
@@ -0,0 +1,354 @@
+"""
+Chunked, indexed RGB-D recordings
+
+A recording is a directory holding
+    meta.json           frame sizes, color/depth intrinsics, depth scale, fps, codecs and chunk size
+    chunk_000000.bin    encoded frames back to back, chunk_frames frames per chunk
+    index.npy           one row per frame: chunk, byte offset and size of its color and depth, timestamp
+                        and the camera's frame number, gaps in which are frames the camera dropped
+
+Depth is stored losslessly as 16-bit PNG (or uncompressed with depth_format='.raw'), color as JPEG
+(or PNG with color_format='.png'). RecordingWriter encodes frames on a thread pool (cv2.imencode
+releases the GIL) and a writer thread appends them to the chunks in order. index.npy is rewritten
+after every chunk, so a recording that was cut off is still readable up to its last complete chunk.
+
+RecordingReader memory-maps the chunks and decodes frames lazily. Only the maps of the most recently
+used chunks are kept; decoded frames are not cached unless cache_frames is set, so a sequential or
+strided pass holds one frame at a time. Frames come back as read-only numpy arrays, raw depth is a
+view straight into the memory map.
+
+Usage:
+------
+    python rgbd_recording.py <dir> [seconds]            Record the RealSense camera at 1280x720
+    python rgbd_recording.py --bench <dir> [frames]     Encode calibration_images/ at 1280x720 and report fps
+    python rgbd_recording.py --read <dir> [step]        Time random access and every step-th frame of a recording
+"""
+
+import collections
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+from frame_source import DEPTH_SCALE, INTRINSICS_FIELDS
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+VERSION = 2
+
+INDEX_DTYPE = np.dtype([('chunk', '<u4'), ('color_offset', '<u8'), ('color_size', '<u4'),
+                        ('depth_offset', '<u8'), ('depth_size', '<u4'), ('timestamp', '<f8'),
+                        ('frame_number', '<u8')])
+
+
+def dropped_frames(frame_numbers):
+    # Number of frames missing between consecutive camera frame numbers
+    steps = np.diff(np.asarray(frame_numbers, dtype=np.int64))
+    return int(np.maximum(steps - 1, 0).sum())
+
+
+def intrinsics_to_dict(intrinsics):
+    # JSON friendly intrinsics from an rs.intrinsics, frame_source.Intrinsics, dict or sequence, None stays None
+    if intrinsics is None or isinstance(intrinsics, dict):
+        return intrinsics
+    if hasattr(intrinsics, 'fx'):
+        out = {f: getattr(intrinsics, f) for f in INTRINSICS_FIELDS}
+        if hasattr(intrinsics, 'coeffs'):
+            out['coeffs'] = list(intrinsics.coeffs)
+    else:
+        out = dict(zip(INTRINSICS_FIELDS, intrinsics))
+    out['width'], out['height'] = int(out['width']), int(out['height'])
+    return out
+
+
+def chunk_path(path, chunk):
+    return os.path.join(path, 'chunk_%06d.bin' % chunk)
+
+
+def _encode(color, depth, color_params, depth_params, color_format, depth_format='.png'):
+    ok_color, color_bytes = cv2.imencode(color_format, color, color_params)
+    if depth_format == '.raw':
+        ok_depth, depth_bytes = True, np.ascontiguousarray(depth).view(np.uint8).ravel()
+    else:
+        ok_depth, depth_bytes = cv2.imencode(depth_format, depth, depth_params)
+    if not (ok_color and ok_depth):
+        raise RuntimeError('Failed to encode frame')
+    return color_bytes, depth_bytes
+
+
+class RecordingWriter:
+    # Appends (color, z16 depth, timestamp) frames to a recording directory. append() copies the frame and
+    # queues it, it blocks when max_pending frames are waiting to be encoded so memory stays bounded. The
+    # first encode or write error stops the recording: later frames are dropped and append() raises it
+
+    def __init__(self, path, color_intrinsics=None, depth_intrinsics=None, depth_scale=DEPTH_SCALE, fps=30,
+                 chunk_frames=30, color_format='.jpg', depth_format='.png', jpeg_quality=95, png_compression=1,
+                 workers=None, max_pending=None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.meta = {'version': VERSION, 'fps': fps, 'depth_scale': depth_scale, 'chunk_frames': chunk_frames,
+                     'color_format': color_format, 'depth_format': depth_format,
+                     'color_intrinsics': intrinsics_to_dict(color_intrinsics),
+                     'depth_intrinsics': intrinsics_to_dict(depth_intrinsics),
+                     'color_shape': None, 'depth_shape': None, 'frames': 0}
+        self.color_format = color_format
+        self.depth_format = depth_format
+        self.color_params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality] if color_format == '.jpg' else \
+            [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+        self.depth_params = [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+        self.chunk_frames = chunk_frames
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='lorde-encode')
+        self._pending = queue.Queue(maxsize=max_pending or 4 * self.workers)
+        self._index = []
+        self._file = None
+        self.bytes_written = 0
+        self.error = None
+        self._writer = threading.Thread(target=self._write_loop, name='lorde-record', daemon=True)
+        self._writer.start()
+        self.frames = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, color, depth, timestamp=None, frame_number=None):
+        # Queue a copy of a frame for encoding, returns its index in the recording. The caller may reuse or
+        # release its buffers (e.g. librealsense frame data) as soon as this returns. frame_number defaults
+        # to that index
+        if self.error is not None:
+            raise self.error
+        if depth.dtype != np.uint16:
+            raise ValueError('depth must be z16 (uint16), got %s' % depth.dtype)
+        if self.meta['color_shape'] is None:
+            self.meta['color_shape'], self.meta['depth_shape'] = list(color.shape), list(depth.shape)
+        timestamp = time.time() if timestamp is None else timestamp
+        frame_number = self.frames if frame_number is None else frame_number
+        future = self.executor.submit(_encode, np.array(color), np.array(depth), self.color_params,
+                                      self.depth_params, self.color_format, self.depth_format)
+        self._pending.put((future, timestamp, frame_number))
+        self.frames += 1
+        return self.frames - 1
+
+    def _write_loop(self):
+        # Writer thread, takes encoded frames in append order and appends them to the current chunk. After an
+        # error the rest of the queue is drained without writing, so the index never skips an appended frame
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+            future, timestamp, frame_number = item
+            if self.error is not None:
+                future.cancel()
+                continue
+            try:
+                color_bytes, depth_bytes = future.result()
+                self._write(color_bytes, depth_bytes, timestamp, frame_number)
+            except Exception as e:
+                self.error = e
+
+    def _write(self, color_bytes, depth_bytes, timestamp, frame_number):
+        frame = len(self._index)
+        chunk = frame // self.chunk_frames
+        if frame % self.chunk_frames == 0:
+            if self._file is not None:
+                self._file.close()
+                self._write_index()
+            self._file = open(chunk_path(self.path, chunk), 'wb')
+        color_offset = self._file.tell()
+        self._file.write(color_bytes.data)
+        depth_offset = self._file.tell()
+        self._file.write(depth_bytes.data)
+        self._index.append((chunk, color_offset, len(color_bytes), depth_offset, len(depth_bytes), timestamp,
+                            frame_number))
+        self.bytes_written += len(color_bytes) + len(depth_bytes)
+
+    def _write_index(self):
+        # index.npy and meta.json for every frame written so far, replaced atomically
+        index = np.array(self._index, dtype=INDEX_DTYPE)
+        meta = dict(self.meta, frames=len(index))
+        for name, save in [('index.npy', lambda f: np.save(f, index)),
+                           ('meta.json', lambda f: f.write(json.dumps(meta, indent=2).encode()))]:
+            tmp = os.path.join(self.path, name + '.tmp')
+            with open(tmp, 'wb') as f:
+                save(f)
+            os.replace(tmp, os.path.join(self.path, name))
+
+    def close(self):
+        # Wait for every queued frame, then write the final index
+        if self._writer is None:
+            return
+        self._pending.put(None)
+        self._writer.join()
+        self._writer = None
+        self.executor.shutdown()
+        if self._file is not None:
+            self._file.close()
+        self._write_index()
+        if self.error is not None:
+            raise self.error
+
+
+class RecordingReader:
+    # Random access to a recording written by RecordingWriter, reader[i] is (color, depth) of frame i.
+    # Memory maps of at most cache_chunks chunks are kept, least recently used first out, so long recordings
+    # do not hold one open map per chunk. A dropped map (and its file descriptor) is released once no raw
+    # depth frame still views into it. cache_frames > 0 also keeps that many decoded frames, for callers
+    # that read the same frames again; each 1280x720 frame is about 4.6 MB
+
+    def __init__(self, path, cache_chunks=4, cache_frames=0):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.index = np.load(os.path.join(path, 'index.npy'))
+        self.timestamps = self.index['timestamp']
+        self.depth_scale = self.meta['depth_scale']
+        self.color_intrinsics = self.meta['color_intrinsics']
+        self.depth_intrinsics = self.meta['depth_intrinsics']
+        self.chunk_frames = self.meta['chunk_frames']
+        self.cache_chunks = cache_chunks
+        self.cache_frames = cache_frames
+        self._maps = collections.OrderedDict()
+        self._frames = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        color, depth, _ = self.frame(i)
+        return color, depth
+
+    def __iter__(self):
+        for _, color, depth, _ in self.iter_frames():
+            yield color, depth
+
+    @staticmethod
+    def _lru(cache, key, size):
+        # Move key to the most recently used end of cache, then drop the oldest entries beyond size
+        if key in cache:
+            cache.move_to_end(key)
+        while len(cache) > size:
+            cache.popitem(last=False)
+
+    def _map(self, chunk):
+        # Memory map of a chunk, opened on first use (call with the lock held)
+        mm = self._maps.get(chunk)
+        if mm is None:
+            mm = self._maps[chunk] = np.memmap(chunk_path(self.path, chunk), dtype=np.uint8, mode='r')
+        self._lru(self._maps, chunk, self.cache_chunks)
+        return mm
+
+    def frame(self, i):
+        # (color, depth, timestamp) of frame i, read-only arrays
+        if i < 0:
+            i += len(self)
+        row = self.index[i]
+        with self._lock:
+            cached = self._frames.get(i)
+            if cached is not None:
+                self._lru(self._frames, i, self.cache_frames)
+                self.hits += 1
+                return cached + (float(row['timestamp']),)
+            self.misses += 1
+            mm = self._map(int(row['chunk']))
+        color_bytes = mm[row['color_offset']:row['color_offset'] + row['color_size']]
+        depth_bytes = mm[row['depth_offset']:row['depth_offset'] + row['depth_size']]
+        color = cv2.imdecode(color_bytes, cv2.IMREAD_COLOR)
+        if self.meta['depth_format'] == '.raw':
+            depth = depth_bytes.view(np.uint16).reshape(self.meta['depth_shape'])  # view into the memory map
+        else:
+            depth = cv2.imdecode(depth_bytes, cv2.IMREAD_UNCHANGED)
+        color.flags.writeable = False
+        depth.flags.writeable = False
+        if self.cache_frames > 0:
+            with self._lock:
+                self._frames[i] = (color, depth)
+                self._lru(self._frames, i, self.cache_frames)
+        return color, depth, float(row['timestamp'])
+
+    def iter_frames(self, start=0, stop=None, step=1):
+        # (i, color, depth, timestamp) of every step-th frame, only those frames are decoded
+        for i in range(*slice(start, stop, step).indices(len(self))):
+            color, depth, timestamp = self.frame(i)
+            yield i, color, depth, timestamp
+
+    def close(self):
+        with self._lock:
+            self._frames.clear()
+            self._maps.clear()
+
+
+def record(source, path, seconds=10, **writer_args):
+    # Record a frame_source for seconds into path, returns the number of frames written and the number of
+    # frames the camera dropped in between (gaps in its frame numbers, e.g. while append() was blocked)
+    frames = source.wait_for_frames()
+    color_frame, depth_frame = frames.get_color_frame(), frames.get_depth_frame()
+    writer = RecordingWriter(path, color_frame.profile.as_video_stream_profile().intrinsics,
+                             depth_frame.profile.as_video_stream_profile().intrinsics,
+                             source.get_depth_scale(), **writer_args)
+    end = time.time() + seconds
+    frame_numbers = []
+    with writer:
+        while time.time() < end:
+            frame_numbers.append(frames.get_frame_number())
+            writer.append(np.asanyarray(color_frame.get_data()), np.asanyarray(depth_frame.get_data()),
+                          frames.get_timestamp() / 1000.0, frame_numbers[-1])
+            frames = source.wait_for_frames()
+            color_frame, depth_frame = frames.get_color_frame(), frames.get_depth_frame()
+    return writer.frames, dropped_frames(frame_numbers)
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == '--bench':
+        from frame_source import load_recording
+        n = int(sys.argv[3]) if len(sys.argv) > 3 else 300
+        frames = [(cv2.resize(c, (1280, 720)), cv2.resize(d, (1280, 720), interpolation=cv2.INTER_NEAREST))
+                  for c, d in load_recording()]
+        start = time.perf_counter()
+        with RecordingWriter(sys.argv[2]) as writer:
+            for i in range(n):
+                color, depth = frames[i % len(frames)]
+                writer.append(color, depth)
+        elapsed = time.perf_counter() - start
+        raw = n * (frames[0][0].nbytes + frames[0][1].nbytes)
+        print('%d frames at 1280x720 in %.2fs: %.1f fps with %d encode threads, %.0f KB per frame (raw %.0f KB)' % (
+            n, elapsed, n / elapsed, writer.workers, writer.bytes_written / n / 1024.0,
+            raw / n / 1024.0))
+    elif sys.argv[1] == '--read':
+        step = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+        start = time.perf_counter()
+        reader = RecordingReader(sys.argv[2])
+        print('opened %d frames in %.1f ms' % (len(reader), (time.perf_counter() - start) * 1000))
+        order = np.random.default_rng(0).permutation(len(reader))[:100]
+        start = time.perf_counter()
+        for i in order:
+            reader[i]
+        print('random access: %.2f ms per frame' % ((time.perf_counter() - start) * 1000 / len(order)))
+        start = time.perf_counter()
+        n = sum(1 for _ in reader.iter_frames(step=step))
+        print('every %dth frame: %d frames in %.2fs' % (step, n, time.perf_counter() - start))
+        start = time.perf_counter()
+        n = sum(1 for _ in reader.iter_frames())
+        print('every frame: %d frames in %.2fs, cache hits %d, misses %d' % (
+            n, time.perf_counter() - start, reader.hits, reader.misses))
+    else:
+        import pyrealsense2 as rs
+        from frame_source import LiveSource
+        config = rs.config()
+        config.enable_stream(rs.stream.depth, 1280, 720, rs.format.z16, 30)
+        config.enable_stream(rs.stream.color, 1280, 720, rs.format.bgr8, 30)
+        source = LiveSource(config).start()
+        try:
+            n, dropped = record(source, sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 10)
+        finally:
+            source.stop()
+        print('recorded %d frames, %d dropped by the camera' % (n, dropped))
@@ -1,25 +1,150 @@
+import contextlib
+import functools
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import cv2                                # state of the art computer vision algorithms library
 import numpy as np                        # fundamental package for scientific computing
 import matplotlib.pyplot as plt           # 2D plotting library producing publication quality figures
 
 from PIL import Image
 
-def color_selection_mask(image, target_hsv=list):
-    img_hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV) 
-    target_hsv = np.tile(target_hsv, (480, 640, 1))
-    
-    distance = np.zeros(img_hsv.shape)
-    h_distance = np.minimum(np.abs(img_hsv[:,:,0:1] - target_hsv[:,:,0:1]), 180 - np.abs(img_hsv[:,:,0:1] - target_hsv[:,:,0:1]))
-    sv_distance = img_hsv[:,:,1:] - target_hsv[:,:,1:]
-    
-    distance[:,:,0:1] = h_distance
-    distance[:,:,1:] = sv_distance
-    
-    distance = np.linalg.norm(distance, axis=2)
-    distance = 255 * distance / distance.max()
-    distance = 255 - distance.astype(np.uint8)
+from frame_source import DEPTH_SCALE, FOV_PER_PIX, INTRINSICS_FIELDS, default_intrinsics
+
+logger = logging.getLogger(__name__)
+
+class StageProfile:
+    # Wall time, call count and array sizes per named stage of the LoRDE pipeline. Pass one as profile= to the
+    # utils functions to fill it, with profile=None every stage is a shared no-op context. Stages that run on
+    # the matching thread pool add up the time spent in every worker
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def stage(self, name, shape=None):
+        return _Stage(self, name, shape)
+
+    def record(self, name, seconds, shape=None):
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'pixels': 0, 'shape': None}
+            ms = seconds * 1000
+            stage['calls'] += 1
+            stage['total_ms'] += ms
+            stage['max_ms'] = max(stage['max_ms'], ms)
+            if shape is not None:
+                stage['pixels'] += int(shape[0]) * int(shape[1]) if len(shape) > 1 else int(shape[0])
+                stage['shape'] = list(shape)
+
+    def to_dict(self):
+        with self._lock:
+            return {name: dict(stage, mean_ms=stage['total_ms'] / stage['calls'])
+                    for name, stage in self.stages.items()}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def __str__(self):
+        lines = ['%-28s %6s %10s %10s %12s' % ('stage', 'calls', 'total ms', 'max ms', 'pixels')]
+        for name, stage in sorted(self.to_dict().items(), key=lambda item: -item[1]['total_ms']):
+            lines.append('%-28s %6d %10.2f %10.2f %12d' % (
+                name, stage['calls'], stage['total_ms'], stage['max_ms'], stage['pixels']))
+        return '\n'.join(lines)
+
+
+class _Stage:
+    __slots__ = ('profile', 'name', 'shape', 'start')
+
+    def __init__(self, profile, name, shape):
+        self.profile, self.name, self.shape = profile, name, shape
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.record(self.name, time.perf_counter() - self.start, self.shape)
+
+
+_NO_STAGE = contextlib.nullcontext()
+
+
+def _stage(profile, name, shape=None):
+    # Timing context for one stage, the shared no-op context when profiling is off
+    return _NO_STAGE if profile is None else profile.stage(name, shape)
+
+
+# Scratch buffers for color_selection_mask, keyed by frame (height, width). Each thread gets its own, so
+# threads masking frames of the same size (e.g. the capture, tracking and UI threads) never share one
+_mask_buffers = threading.local()
+
+
+def _mask_workspace(shape):
+    buffers = getattr(_mask_buffers, 'by_shape', None)
+    if buffers is None:
+        buffers = _mask_buffers.by_shape = {}
+    ws = buffers.get(shape)
+    if ws is None:
+        ws = {'hsv': np.empty(shape + (3,), dtype=np.uint8),
+              'planes': [np.empty(shape, dtype=np.uint8) for _ in range(3)],
+              'distance': np.empty(shape, dtype=np.float32),
+              'term': np.empty(shape, dtype=np.float32)}
+        buffers[shape] = ws
+    return ws
 
-    return distance
+
+@functools.lru_cache(maxsize=16)
+def _hsv_distance_luts(target_hsv):
+    # Squared per-channel distance to the target for every possible uint8 value, hue wraps around at 180
+    values = np.arange(256, dtype=np.float32)
+    h_distance = np.abs(values - target_hsv[0])
+    h_distance = np.minimum(h_distance, 180 - h_distance)
+    return tuple((d ** 2).reshape(1, 256) for d in
+                 (h_distance, values - target_hsv[1], values - target_hsv[2]))
+
+
+def color_selection_mask(image, target_hsv=list, out=None, profile=None):
+    with _stage(profile, 'color_selection_mask', image.shape):
+        return _color_selection_mask(image, target_hsv, out)
+
+
+def _color_selection_mask(image, target_hsv, out=None):
+    # Works at any frame size, the target is never tiled to the image shape
+    ws = _mask_workspace(image.shape[:2])
+    img_hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV, dst=ws['hsv'])
+    h, s, v = cv2.split(img_hsv, ws['planes'])
+    h_lut, s_lut, v_lut = _hsv_distance_luts(tuple(float(c) for c in target_hsv))
+
+    # Sum the squared channel distances with table lookups, all in float32
+    distance, term = ws['distance'], ws['term']
+    cv2.LUT(h, h_lut, dst=distance)
+    cv2.LUT(s, s_lut, dst=term)
+    cv2.add(distance, term, dst=distance)
+    cv2.LUT(v, v_lut, dst=term)
+    cv2.add(distance, term, dst=distance)
+    cv2.sqrt(distance, dst=distance)
+
+    max_distance = cv2.minMaxLoc(distance)[1]
+    if max_distance > 0:
+        np.multiply(distance, 255 / max_distance, out=distance)
+
+    if out is None:
+        out = np.empty(image.shape[:2], dtype=np.uint8)
+    out[...] = distance
+    np.subtract(255, out, out=out)
+
+    return out
+
+
+def canny_thresholds(v, sigma=0.33):
+    # Hysteresis thresholds around the median intensity v
+    lower = int(max(0, (1.0 - sigma) * v))
+    upper = int(min(255, (1.0 + sigma) * v))
+    return lower, upper
 
 
 def auto_canny(image, sigma=0.33):
@@ -27,32 +152,222 @@ def auto_canny(image, sigma=0.33):
     v = np.median(image)
 
     # Apply automatic Canny edge detection using the computed median
-    lower = int(max(0, (1.0 - sigma) * v))
-    upper = int(min(255, (1.0 + sigma) * v))
+    lower, upper = canny_thresholds(v, sigma)
     edged = cv2.Canny(image, lower, upper)
 
     return edged
 
 
-def multiscale_template_matching(image, template_canny, max_scale=4, num_scales=61, do_visualize=False):    
+def resize_window(image, scale, origin, size):
+    # Render only the (x, y, w, h) window of cv2.resize(image, (0,0), fx=scale, fy=scale)
+    # using the same pixel-center convention as cv2.resize
+    x, y = origin
+    M = np.float32([[scale, 0, 0.5 * scale - 0.5 - x],
+                    [0, scale, 0.5 * scale - 0.5 - y]])
+    return cv2.warpAffine(image, M, size, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+class EdgePyramid:
+    # Per-frame cache of resized auto_canny edge maps keyed by scale, shared by every
+    # template and match iteration that searches the same frame. Binding a different frame drops every
+    # level, and when max_bytes would be exceeded the largest levels are evicted first.
+    # The cache cannot see new contents written into the same array: call reset() for every new frame, or
+    # give lorde_from_roi a frame_id (e.g. the capture index) that changes with every frame
+
+    def __init__(self, max_bytes=64 * 2**20):
+        self.max_bytes = max_bytes
+        self.image = None
+        self.frame_id = None
+        self.levels = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def reset(self, image=None, frame_id=None):
+        # Bind a new frame, frame_id identifies the frame the image was derived from (None: unknown)
+        with self._lock:
+            if self.image is not None:
+                self.invalidations += 1
+            self.image = image
+            self.frame_id = frame_id
+            self.levels = {}
+            self.nbytes = 0
+
+    def edges(self, image, scale, profile=None):
+        # auto_canny of image resized by scale, built at most once per frame. Only a different image array
+        # rebinds the cache here, reused buffers need an explicit reset()
+        if image is not self.image:
+            self.reset(image)
+        with self._lock:
+            edged = self.levels.get(scale)
+            if edged is not None:
+                self.hits += 1
+                return edged
+            self.misses += 1
+
+        edged = _scaled_edges(image, scale, profile)
+
+        with self._lock:
+            if image is self.image and scale not in self.levels:
+                self._store(scale, edged)
+        return edged
+
+    def _store(self, scale, edged):
+        while self.levels and self.nbytes + edged.nbytes > self.max_bytes:
+            largest = max(self.levels, key=lambda s: self.levels[s].nbytes)
+            if self.levels[largest].nbytes < edged.nbytes:
+                # The new level is the largest one, leave the smaller levels cached instead
+                return
+            self.nbytes -= self.levels.pop(largest).nbytes
+            self.evictions += 1
+        if edged.nbytes <= self.max_bytes:
+            self.levels[scale] = edged
+            self.nbytes += edged.nbytes
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions, 'invalidations': self.invalidations,
+                'levels': len(self.levels), 'bytes': self.nbytes}
+
+
+def _scaled_edges(image, scale, profile=None):
+    with _stage(profile, 'resize', image.shape):
+        resized = cv2.resize(image, (0,0), fx=scale, fy=scale)
+    with _stage(profile, 'canny', resized.shape):
+        return auto_canny(resized)
+
+
+def _resized_edges(image, scale, edge_cache=None, profile=None):
+    if edge_cache is None:
+        return _scaled_edges(image, scale, profile)
+    return edge_cache.edges(image, scale, profile)
+
+
+# Thread pools for parallel scale evaluation, keyed by worker count and reused across calls
+_thread_pools = {}
+
+
+def _map_scales(fn, items, workers=None):
+    # Serial map when workers is None or 1, otherwise results come back in input order from a
+    # thread pool, OpenCV releases the GIL inside resize, Canny and matchTemplate
+    if workers is None or workers <= 1:
+        return map(fn, items)
+    pool = _thread_pools.get(workers)
+    if pool is None:
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='lorde-match')
+        _thread_pools[workers] = pool
+    return pool.map(fn, items)
+
+
+def _box_intersection(box_a, box_b):
+    ((ax1, ay1), (ax2, ay2)), ((bx1, by1), (bx2, by2)) = box_a, box_b
+    iw = max(0, min(ax2, bx2) - max(ax1, bx1))
+    ih = max(0, min(ay2, by2) - max(ay1, by1))
+    return iw * ih, (ax2 - ax1) * (ay2 - ay1), (bx2 - bx1) * (by2 - by1)
+
+
+def box_iou(box_a, box_b):
+    # Intersection over union of two ((x1, y1), (x2, y2)) boxes
+    inter, area_a, area_b = _box_intersection(box_a, box_b)
+    union = area_a + area_b - inter
+    return inter / float(union) if union else 0.0
+
+
+def box_overlap(box_a, box_b):
+    # Intersection over the smaller box, so a box nested inside another counts as fully overlapping
+    inter, area_a, area_b = _box_intersection(box_a, box_b)
+    smaller = min(area_a, area_b)
+    return inter / float(smaller) if smaller else 0.0
+
+
+def non_max_suppression(matches, max_objects, overlap_thresh=0.3):
+    # Greedily keep the best scoring matches that overlap every kept box by at most overlap_thresh,
+    # the sort is stable so equal scores keep their scale order
+    kept = []
+    for match in sorted(matches, key=lambda m: -m['score']):
+        if all(box_overlap(match['box'], k['box']) <= overlap_thresh for k in kept):
+            kept.append(match)
+            if len(kept) == max_objects:
+                break
+    return kept
+
+
+def _candidate_box(loc, r, tW, tH):
+    # Map a match location in a resized frame back to a box in the original frame
+    (startX, startY) = (int(loc[0] * r), int(loc[1] * r))
+    (endX, endY) = (int((loc[0] + tW) * r), int((loc[1] + tH) * r))
+    return ((startX, startY), (endX, endY))
+
+
+def _score_peaks(result, num_peaks, suppress):
+    # Strongest num_peaks locations of a matchTemplate score map, blanking a (w, h) neighbourhood
+    # around each one so an object only contributes one peak per scale
+    if num_peaks == 1:
+        (_, maxVal, _, maxLoc) = cv2.minMaxLoc(result)
+        return [(maxVal, maxLoc)]
+    (sW, sH) = suppress
+    peaks = []
+    for _ in range(num_peaks):
+        (_, maxVal, _, maxLoc) = cv2.minMaxLoc(result)
+        if not np.isfinite(maxVal):
+            break
+        peaks.append((maxVal, maxLoc))
+        (x, y) = maxLoc
+        result[max(0, y - sH):y + sH + 1, max(0, x - sW):x + sW + 1] = -np.inf
+    return peaks
+
+
+def _match_at_scale(image, template, scale, keep_edges=False, num_peaks=1, edge_cache=None, profile=None):
+    # Resize the image according to the scale, and keep track of the ratio of the resizing
+    (tH, tW) = template.shape[:2]
+    rW, rH = int(round(image.shape[1] * scale)), int(round(image.shape[0] * scale))
+    # If the resized image is smaller than the template there is nothing to match
+    if rH < tH or rW < tW:
+        return None
+    r = image.shape[1] / float(rW)
+
+    # Detect edges in the resized, grayscale image and apply template matching to find the template in the image
+    edged = _resized_edges(image, scale, edge_cache, profile)
+    with _stage(profile, 'matchTemplate', edged.shape):
+        result = cv2.matchTemplate(edged, template, cv2.TM_CCOEFF)
+    with _stage(profile, 'score_peaks', result.shape):
+        peaks = _score_peaks(result, num_peaks, (tW // 2, tH // 2))
+
+    return (peaks, r, edged if keep_edges else None)
+
+
+def multiscale_template_matching(image, template_canny, max_scale=4, num_scales=61, do_visualize=False,
+                                 coarse_to_fine=False, coarse_factor=0.5, coarse_step=4, refine_margin=8,
+                                 workers=None, edge_cache=None, profile=None):
+    if coarse_to_fine:
+        return coarse_to_fine_template_matching(image, template_canny, max_scale, num_scales, coarse_factor,
+                                                coarse_step, refine_margin, workers, edge_cache, profile)
+
     found = None
     template = template_canny #auto_canny(template) # Just pass in canny of template to save time
     (tH, tW) = template.shape[:2]
-    
-    # Loop over the scales of the image
-    for scale in np.linspace(1, max_scale, num_scales)[::-1]:
-        # Resize the image according to the scale, and keep track of the ratio of the resizing
-        resized = cv2.resize(image, (0,0), fx=scale, fy=scale)
-        r = image.shape[1] / float(resized.shape[1])
-        # If the resized image is smaller than the template, then break from the loop
-        if resized.shape[0] < tH or resized.shape[1] < tW:
+    scales = np.linspace(1, max_scale, num_scales)[::-1]
+
+    # Visualizing needs the edge maps in order, so it always runs serially
+    if do_visualize:
+        workers = None
+    match = lambda scale: _match_at_scale(image, template, scale, keep_edges=do_visualize, edge_cache=edge_cache,
+                                          profile=profile)
+
+    # Loop over the scale results in descending scale order, so ties resolve the same way
+    # whether the scales were evaluated serially or on the thread pool
+    for scale_result in _map_scales(match, scales, workers):
+        # Once the resized image is smaller than the template every smaller scale is too
+        if scale_result is None:
             break
-    
-        # Detect edges in the resized, grayscale image and apply template matching to find the template in the image
-        edged = auto_canny(resized)
-        result = cv2.matchTemplate(edged, template, cv2.TM_CCOEFF)
-        (_, maxVal, _, maxLoc) = cv2.minMaxLoc(result)
-        
+        (peaks, r, edged) = scale_result
+        (maxVal, maxLoc) = peaks[0]
+
         # Check to see if the iteration should be visualized
         if do_visualize:
             # Draw a bounding box around the detected region
@@ -74,107 +389,631 @@ def multiscale_template_matching(image, template_canny, max_scale=4, num_scales=
     return {'box': ((startX, startY), (endX, endY)), 'scale': r}
 
 
-def find_matching_boxes(image, template):
-    # Parameters and their default values
-    MAX_MATCHING_OBJECTS = 2
-
-    # Find keypoints and descriptors for the template
-
-    matched_boxes = []
-    scales = []
-    matching_img = image.copy()
-    template_canny = auto_canny(template)
-
-    for i in range(MAX_MATCHING_OBJECTS):
-        # Find bounding boxes using template matching
-        output = multiscale_template_matching(matching_img, template_canny)
-        box = output['box']
-        scale = output['scale']
-        
-        matched_boxes.append(box)
-        scales.append(scale)
-        
-        if i == MAX_MATCHING_OBJECTS - 1:
-            break
-        
-        # Create a mask and fill the matched area with near neighbors
-        corners = np.array([[[box[0][0], box[0][1]]],
-                            [[box[0][0], box[1][1]]],
-                            [[box[1][0], box[1][1]]],
-                            [[box[1][0], box[0][1]]]])
-        mask = np.ones_like(matching_img) * 255
-        cv2.fillPoly(mask, [np.int32(corners)], 0)
-        mask = cv2.bitwise_not(mask)
-        matching_img = cv2.inpaint(matching_img, mask, 3, cv2.INPAINT_TELEA)
-
-        #plt.imshow(mask, 'gray')
-        #plt.show()
-        #plt.imshow(matching_img, 'gray')
-        #plt.show()
-
-    return matched_boxes, scales
-
-
-def depth_from_boxes(depth, boxes):
-    # Assume first box is always closest box, for now only works with 2 boxes
-    fov_per_pix = 0.1491
-    depth_scale = 0.0010000000474974513
-    box1, box2 = boxes
-
-    # Get pixel dimentions and depth of closest box
-    height_close_pixels = abs(box1[1][1] - box1[0][1])
-    width_close_pixels = abs(box1[1][0] - box1[0][0])
-    depth_close = np.median(depth[box1[0][1]:box1[1][1], box1[0][0]:box1[1][0]])  * depth_scale
+def _coarse_match_at_scale(image, small_template, scale, num_peaks=1, edge_cache=None, profile=None):
+    (sH, sW) = small_template.shape[:2]
+    rW, rH = int(round(image.shape[1] * scale)), int(round(image.shape[0] * scale))
+    if rH < sH or rW < sW:
+        return None
+    edged = _resized_edges(image, scale, edge_cache, profile)
+    with _stage(profile, 'matchTemplate', edged.shape):
+        result = cv2.matchTemplate(edged, small_template, cv2.TM_CCOEFF)
+    with _stage(profile, 'score_peaks', result.shape):
+        peaks = _score_peaks(result, num_peaks, (sW // 2, sH // 2))
+    return (peaks, image.shape[1] / float(rW))
 
-    print('Height of close object in pixels', height_close_pixels)
-    print('Width of close object in pixels', width_close_pixels)
-    print('Depth of close object:', depth_close)
 
-    # Compute angular dimentions of closest box
-    angular_size_height_close = height_close_pixels * fov_per_pix
-    angular_size_width_close = width_close_pixels * fov_per_pix
-
-    # Convert angular dimentions and stereo depth to physical dimentions of closest box
-    height_close = 2 * depth_close * np.tan(np.deg2rad(angular_size_height_close)/2)
-    width_close = 2 * depth_close * np.tan(np.deg2rad(angular_size_width_close)/2)
+def _refine_match_at_scale(image, template, scale, guess, margin, thresholds, profile=None):
+    # Match the full resolution template inside a window around the guessed top-left corner
+    (tH, tW) = template.shape[:2]
+    (H, W) = image.shape[:2]
+    rW, rH = int(round(W * scale)), int(round(H * scale))
+    (x, y) = guess
+    x0, y0 = max(0, x - margin), max(0, y - margin)
+    x1, y1 = min(rW, x + tW + margin), min(rH, y + tH + margin)
+    if x1 - x0 < tW or y1 - y0 < tH:
+        return None
+
+    # Pad the window by a few pixels so the Sobel and hysteresis steps see the same neighbours
+    pad = 3
+    px0, py0 = max(0, x0 - pad), max(0, y0 - pad)
+    px1, py1 = min(rW, x1 + pad), min(rH, y1 + pad)
+    with _stage(profile, 'resize', (py1 - py0, px1 - px0)):
+        window = resize_window(image, scale, (px0, py0), (px1 - px0, py1 - py0))
+    with _stage(profile, 'canny', window.shape):
+        edged = cv2.Canny(window, *thresholds)[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+
+    with _stage(profile, 'matchTemplate', edged.shape):
+        result = cv2.matchTemplate(edged, template, cv2.TM_CCOEFF)
+        (_, maxVal, _, maxLoc) = cv2.minMaxLoc(result)
+    return (maxVal, (maxLoc[0] + x0, maxLoc[1] + y0), W / float(rW))
 
-    print('')
-    print('Height of close object', height_close)
-    print('Width of close object', width_close)
 
-    # Get pixel dimentions of farther box
-    height_far_pixels = abs(box2[1][1] - box2[0][1])
-    width_far_pixels = abs(box2[1][0] - box2[0][0])
-    depth_far = np.median(depth[box2[0][1]:box2[1][1], box2[0][0]:box2[1][0]]) * depth_scale
+def _grid_candidates(image, template, scales, num_peaks, workers=None, edge_cache=None, profile=None):
+    # Every per-scale score peak of the exhaustive grid as (score, loc, r)
+    candidates = []
+    match = lambda scale: _match_at_scale(image, template, scale, num_peaks=num_peaks, edge_cache=edge_cache,
+                                          profile=profile)
+    for scale_result in _map_scales(match, scales, workers):
+        if scale_result is None:
+            break
+        (peaks, r, _) = scale_result
+        candidates.extend((maxVal, maxLoc, r) for (maxVal, maxLoc) in peaks)
+    return candidates
 
-    print('')
-    print('Height of far object in pixels', height_far_pixels)
-    print('Width of far object in pixels', width_far_pixels)
 
-    # Compute angular dimentions of farther box
-    angular_size_height_far = height_far_pixels * fov_per_pix
-    angular_size_width_far = width_far_pixels * fov_per_pix
+def _coarse_to_fine_candidates(image, template, scales, num_seeds, coarse_factor, coarse_step, refine_margin,
+                               overlap_thresh=0.3, workers=None, edge_cache=None, profile=None):
+    # Score every coarse_step-th scale of the grid at coarse_factor resolution, keep the num_seeds best
+    # non-overlapping coarse peaks, then rescore each at the neighbouring scales at full resolution in a
+    # window around its coarse location. Returns the best (score, loc, r) per seed
+    (tH, tW) = template.shape[:2]
 
-    # Compute depth angular dimentions known physical dimentions
-    depth_from_height_far = height_close / (2 * np.tan(np.deg2rad(angular_size_height_far)/2))
-    depth_from_width_far =  width_close / (2 * np.tan(np.deg2rad(angular_size_width_far)/2))
-    depth_mean_far = np.mean([depth_from_height_far, depth_from_width_far])
+    # Coarse pass, the template is shrunk with area averaging so its edges survive as soft weights
+    small_template = cv2.resize(template, (0,0), fx=coarse_factor, fy=coarse_factor, interpolation=cv2.INTER_AREA)
+    (sH, sW) = small_template.shape[:2]
+    coarse_indices = range(0, len(scales), coarse_step)
+    coarse_match = lambda i: _coarse_match_at_scale(image, small_template, scales[i] * coarse_factor, num_seeds,
+                                                    edge_cache, profile)
+    seeds = []
+    for i, scale_result in zip(coarse_indices, _map_scales(coarse_match, coarse_indices, workers)):
+        if scale_result is None:
+            break
+        (peaks, r) = scale_result
+        seeds.extend({'score': maxVal, 'box': _candidate_box(maxLoc, r, sW, sH), 'loc': maxLoc, 'index': i}
+                     for (maxVal, maxLoc) in peaks)
+    seeds = non_max_suppression(seeds, num_seeds, overlap_thresh)
+
+    # Fine pass, Canny thresholds come from the source median since resizing barely moves it
+    thresholds = canny_thresholds(np.median(image))
+
+    def refine(job):
+        (seed, i) = job
+        # Expected top-left corner of the template in this scale's resized frame
+        ratio = scales[i] / (scales[seed['index']] * coarse_factor)
+        guess = (int(seed['loc'][0] * ratio), int(seed['loc'][1] * ratio))
+        margin = refine_margin + int(np.ceil(ratio))
+        return _refine_match_at_scale(image, template, scales[i], guess, margin, thresholds, profile)
+
+    jobs = [(k, i) for k, seed in enumerate(seeds)
+            for i in range(max(0, seed['index'] - coarse_step + 1), min(len(scales), seed['index'] + coarse_step))]
+    best = [None] * len(seeds)
+    for (k, _), scale_result in zip(jobs, _map_scales(refine, [(seeds[k], i) for (k, i) in jobs], workers)):
+        if scale_result is not None and (best[k] is None or scale_result[0] > best[k][0]):
+            best[k] = scale_result
+
+    return [found for found in best if found is not None]
+
+
+def coarse_to_fine_template_matching(image, template_canny, max_scale=4, num_scales=61,
+                                     coarse_factor=0.5, coarse_step=4, refine_margin=8, workers=None, edge_cache=None,
+                                     profile=None):
+    # Score a sparse set of scales at reduced resolution, then refine around the best one at full resolution
+    matches = multiscale_template_peaks(image, template_canny, 1, max_scale, num_scales, coarse_to_fine=True,
+                                        coarse_factor=coarse_factor, coarse_step=coarse_step,
+                                        refine_margin=refine_margin, workers=workers, edge_cache=edge_cache,
+                                        profile=profile)
+    return {'box': matches[0]['box'], 'scale': matches[0]['scale']}
+
+
+def multiscale_template_peaks(image, template_canny, max_objects=2, max_scale=4, num_scales=61, overlap_thresh=0.3,
+                              peaks_per_scale=None, coarse_to_fine=False, coarse_factor=0.5, coarse_step=4,
+                              refine_margin=8, workers=None, edge_cache=None, profile=None):
+    # Best max_objects non-overlapping matches across every scale from a single pass over the image,
+    # returned best first as {'box', 'scale', 'score'} dicts
+    template = template_canny
+    (tH, tW) = template.shape[:2]
+    scales = np.linspace(1, max_scale, num_scales)[::-1]
+    if peaks_per_scale is None:
+        # Spare peaks per scale in case the best ones are suppressed by a box found at another scale
+        peaks_per_scale = 2 * max_objects - 1
+
+    candidates = []
+    if coarse_to_fine:
+        candidates = _coarse_to_fine_candidates(image, template, scales, peaks_per_scale, coarse_factor,
+                                                coarse_step, refine_margin, overlap_thresh, workers, edge_cache,
+                                                profile)
+    if not candidates:
+        # Exhaustive grid, also the fallback when no coarse peak could be refined
+        candidates = _grid_candidates(image, template, scales, peaks_per_scale, workers, edge_cache, profile)
+
+    with _stage(profile, 'non_max_suppression', (len(candidates),)):
+        matches = [{'box': _candidate_box(maxLoc, r, tW, tH), 'scale': r, 'score': maxVal}
+                   for (maxVal, maxLoc, r) in candidates]
+        return non_max_suppression(matches, max_objects, overlap_thresh)
+
+
+def find_matching_boxes(image, template, max_matching_objects=2, coarse_to_fine=True, overlap_thresh=0.3,
+                        workers=None, edge_cache=None, profile=None):
+    # Boxes and scales of the best non-overlapping template matches, best first
+    with _stage(profile, 'canny', template.shape):
+        template_canny = auto_canny(template)
+    matches = multiscale_template_peaks(image, template_canny, max_matching_objects, overlap_thresh=overlap_thresh,
+                                        coarse_to_fine=coarse_to_fine, workers=workers, edge_cache=edge_cache,
+                                        profile=profile)
+
+    matched_boxes = [match['box'] for match in matches]
+    scales = [match['scale'] for match in matches]
 
-    print('')
-    print('Depth from height:', depth_from_height_far)
-    print('Depth from width:', depth_from_width_far)
-    print('Average depth:', np.mean([depth_from_height_far, depth_from_width_far]))
-    
-    return [(None, depth_close), (depth_mean_far, depth_far)]
+    return matched_boxes, scales
 
 
-def lorde_from_roi(roi_coords, bgr_frame, depth):
+class BoxTracker:
+    # Follows the boxes of find_matching_boxes across frames. After a full search each box is re-localized
+    # in a window of search_margin pixels around its last position over num_scales scales within
+    # scale_band of its last scale. A full search runs again when a box scores below min_score_ratio of
+    # its score at the last full search or two boxes collapse onto the same object
+
+    def __init__(self, template, max_matching_objects=2, search_margin=16, scale_band=0.1, num_scales=5,
+                 min_score_ratio=0.6, overlap_thresh=0.3, workers=None):
+        self.template_canny = auto_canny(template)
+        self.max_matching_objects = max_matching_objects
+        self.search_margin = search_margin
+        self.scale_band = scale_band
+        self.num_scales = num_scales
+        self.min_score_ratio = min_score_ratio
+        self.overlap_thresh = overlap_thresh
+        self.workers = workers
+        self.tracks = []  # {'box', 'scale', 'score', 'reference_score'} per box, best first at the last full search
+        self.full_searches = 0
+        self.local_searches = 0
+
+    def reset(self):
+        self.tracks = []
+
+    def update(self, image, edge_cache=None, profile=None):
+        # Boxes and scales in image, like find_matching_boxes
+        tracks = self._track(image, profile) if self.tracks else None
+        if tracks is None:
+            tracks = self._full_search(image, edge_cache, profile)
+        self.tracks = tracks
+        return [t['box'] for t in tracks], [t['scale'] for t in tracks]
+
+    def _full_search(self, image, edge_cache=None, profile=None):
+        self.full_searches += 1
+        with _stage(profile, 'full_search', image.shape):
+            matches = multiscale_template_peaks(image, self.template_canny, self.max_matching_objects,
+                                                overlap_thresh=self.overlap_thresh, coarse_to_fine=True,
+                                                workers=self.workers, edge_cache=edge_cache, profile=profile)
+        return [dict(match, reference_score=match['score']) for match in matches]
+
+    def _track(self, image, profile=None):
+        # Re-localized tracks, or None when a full search is needed
+        self.local_searches += 1
+        (tH, tW) = self.template_canny.shape[:2]
+        with _stage(profile, 'local_search', image.shape):
+            thresholds = canny_thresholds(np.median(image))
+
+            def relocate(track):
+                ((x1, y1), _) = track['box']
+                best = None
+                # The search scale is the inverse of the box scale, box size = template size * r
+                for scale in (1.0 / track['scale']) * np.linspace(1 - self.scale_band, 1 + self.scale_band,
+                                                                   self.num_scales):
+                    guess = (int(x1 * scale), int(y1 * scale))
+                    margin = int(np.ceil(self.search_margin * scale))
+                    found = _refine_match_at_scale(image, self.template_canny, scale, guess, margin, thresholds,
+                                                   profile)
+                    if found is not None and (best is None or found[0] > best[0]):
+                        best = found
+                return best
+
+            tracks = []
+            for track, found in zip(self.tracks, _map_scales(relocate, self.tracks, self.workers)):
+                if found is None or found[0] < self.min_score_ratio * track['reference_score']:
+                    return None
+                (maxVal, maxLoc, r) = found
+                tracks.append({'box': _candidate_box(maxLoc, r, tW, tH), 'scale': r, 'score': maxVal,
+                               'reference_score': track['reference_score']})
+        for i, track in enumerate(tracks):
+            if any(box_overlap(track['box'], other['box']) > self.overlap_thresh for other in tracks[:i]):
+                return None
+        return tracks
+
+
+def boxes_to_array(boxes):
+    # ((x1, y1), (x2, y2)) boxes to an (N, 4) array of x1, y1, x2, y2
+    return np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+
+
+def _histogram_percentiles(values, q):
+    # Percentiles of the non-zero values of an integer array from its cumulative histogram, O(n) in the
+    # number of values, interpolating between ranks like np.percentile. Returns them with the valid count
+    top = int(values.max()) + 1
+    if values.dtype in (np.uint8, np.uint16):
+        hist = cv2.calcHist([values], [0], None, [top], [0, top]).ravel()
+    else:
+        hist = np.bincount(values.ravel(), minlength=top)
+    cum = np.cumsum(hist[1:], dtype=np.float64)  # bin 0 holds the invalid pixels
+    n = int(cum[-1]) if len(cum) else 0
+    if n == 0:
+        return np.full(len(q), np.nan), 0
+
+    rank = q / 100.0 * (n - 1)
+    lo, hi = np.floor(rank), np.ceil(rank)
+    v_lo = np.searchsorted(cum, lo + 1) + 1
+    v_hi = np.searchsorted(cum, hi + 1) + 1
+    return v_lo + (v_hi - v_lo) * (rank - lo), n
+
+
+def box_percentiles(depth, boxes, q=50):
+    # q-th percentiles of the valid (non-zero) depth values inside each (x1, y1, x2, y2) box, and the fraction
+    # of each box's pixels that are valid. Integer z16 frames use one histogram per box, float frames fall
+    # back to np.percentile. Boxes without valid pixels give NaN
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    q_values = np.atleast_1d(np.asarray(q, dtype=np.float64))
+    (H, W) = depth.shape[:2]
+    values = np.full((len(boxes), len(q_values)), np.nan)
+    valid_fraction = np.zeros(len(boxes))
+
+    for k, (x1, y1, x2, y2) in enumerate(np.clip(boxes, 0, [W, H, W, H])):
+        roi = depth[y1:y2, x1:x2]
+        if roi.size == 0:
+            continue
+        if depth.dtype.kind in 'ui':
+            values[k], n = _histogram_percentiles(roi, q_values)
+        else:
+            valid = roi[roi > 0]
+            n = valid.size
+            if n:
+                values[k] = np.percentile(valid, q_values)
+        valid_fraction[k] = n / float(roi.size)
+
+    if np.ndim(q) == 0:
+        values = values[:, 0]
+    return values, valid_fraction
+
+
+def box_medians(depth, boxes):
+    # Median of the valid depth values inside each box, and the valid pixel fraction
+    return box_percentiles(depth, boxes, 50)
+
+
+@functools.lru_cache(maxsize=16)
+def _sorting_network(n):
+    # Compare-exchange pairs (i, j), i < j, of Batcher's odd-even merge sort for n elements. Built for the next
+    # power of two, pairs reaching past n are dropped as if those elements were +inf
+    pairs = []
+    size = 1
+    while size < n:
+        size *= 2
+    p = 1
+    while p < size:
+        k = p
+        while k >= 1:
+            for j in range(k % p, size - k, 2 * k):
+                for i in range(min(k, size - j - k)):
+                    if (i + j) // (2 * p) == (i + j + k) // (2 * p) and i + j + k < n:
+                        pairs.append((i + j, i + j + k))
+            k //= 2
+        p *= 2
+    return tuple(pairs)
+
+
+class DepthAccumulator:
+    # Temporal statistics of the last k z16 depth frames, kept in a preallocated (k, H, W) ring. update() is
+    # O(H*W): it swaps one frame into the ring and adjusts the per-pixel running sum and valid (non-zero)
+    # count. The median sorts the k samples of every pixel and is only computed when asked for, once per update
+
+    MAX_FRAMES = 255  # the per-pixel valid count is uint8
+
+    def __init__(self, k=8, shape=None, min_valid=1):
+        if not 1 <= k <= self.MAX_FRAMES:
+            raise ValueError('k must be between 1 and %d, got %r' % (self.MAX_FRAMES, k))
+        self.k = k
+        self.min_valid = min_valid  # pixels valid in fewer frames come out as 0 (invalid)
+        self.ring = None
+        self.frames = 0  # frames seen, the ring holds the last min(frames, k)
+        self._median = None
+        if shape is not None:
+            self._allocate(tuple(shape))
+
+    def _allocate(self, shape):
+        self.ring = np.zeros((self.k,) + shape, dtype=np.uint16)
+        self.sum = np.zeros(shape, dtype=np.uint32)
+        self.count = np.zeros(shape, dtype=np.uint8)
+        self._valid = np.empty(shape, dtype=bool)
+        self._sorted = np.empty_like(self.ring)
+        self._tmp = np.empty(shape, dtype=np.uint16)
+        self._pixels = np.arange(int(np.prod(shape)), dtype=np.int64).reshape(shape)
+        self.frames = 0
+        self._median = None
+
+    def reset(self):
+        if self.ring is not None:
+            self._allocate(self.ring.shape[1:])
+
+    def __len__(self):
+        return min(self.frames, self.k)
+
+    def update(self, depth):
+        # Add a z16 frame, replacing the oldest one once k frames are held. A new frame size starts over
+        if self.ring is None or self.ring.shape[1:] != depth.shape:
+            self._allocate(depth.shape)
+        slot = self.ring[self.frames % self.k]
+        if self.frames >= self.k:
+            np.subtract(self.sum, slot, out=self.sum)
+            np.greater(slot, 0, out=self._valid)
+            np.subtract(self.count, self._valid, out=self.count, casting='unsafe')
+        slot[...] = depth
+        np.add(self.sum, slot, out=self.sum)
+        np.greater(slot, 0, out=self._valid)
+        np.add(self.count, self._valid, out=self.count, casting='unsafe')
+        self.frames += 1
+        self._median = None
+        return self
+
+    def valid(self):
+        # Pixels valid in at least min_valid of the held frames
+        return self.count >= max(self.min_valid, 1)
+
+    def mean(self):
+        # float32 mean of the valid samples per pixel in z16 units, 0 where there are too few
+        out = np.zeros(self.sum.shape, dtype=np.float32)
+        np.divide(self.sum, self.count, out=out, where=self.valid())
+        return out
+
+    def median(self, region=None):
+        # z16 median of the valid samples per pixel (the two middle samples averaged), 0 where there are too few.
+        # region=(x1, y1, x2, y2) only computes it inside that box, the rest of the frame is 0
+        (H, W) = self.ring.shape[1:]
+        x1, y1, x2, y2 = (0, 0, W, H) if region is None else np.clip(region, 0, [W, H, W, H])
+        key = (self.frames, int(x1), int(y1), int(x2), int(y2))
+        if self._median is not None and self._median[0] == key:
+            return self._median[1]
+
+        # Contiguous scratch for the region at the start of the preallocated buffers
+        n, h, w = len(self), max(y2 - y1, 0), max(x2 - x1, 0)
+        held = self._sorted.reshape(-1)[:n * h * w].reshape(n, h, w)
+        held[...] = self.ring[:n, y1:y2, x1:x2]
+        tmp = self._tmp.reshape(-1)[:h * w].reshape(h, w)
+        pixels = self._pixels.reshape(-1)[:h * w].reshape(h, w)
+        # Sort the n planes with a fixed compare-exchange network, whole planes at a time instead of a
+        # strided sort per pixel. Zeros (invalid) sort first, the count valid samples are at the end
+        for i, j in _sorting_network(n):
+            np.minimum(held[i], held[j], out=tmp)
+            np.maximum(held[i], held[j], out=held[j])
+            held[i] = tmp
+        # Flat indices of the two middle valid samples, pixels without any are clipped and zeroed below
+        count = self.count[y1:y2, x1:x2].astype(np.int64)
+        lo = held.ravel().take((n - count + (count - 1) // 2).clip(0, n - 1) * (h * w) + pixels)
+        hi = held.ravel().take((n - count + count // 2).clip(0, n - 1) * (h * w) + pixels)
+        block = ((lo.astype(np.uint32) + hi + 1) // 2).astype(np.uint16)
+        block[count < max(self.min_valid, 1)] = 0
+
+        if region is None:
+            median = block
+        else:
+            median = np.zeros((H, W), dtype=np.uint16)
+            median[y1:y2, x1:x2] = block
+        self._median = (key, median)
+        return median
+
+
+def intrinsics_key(intrinsics):
+    # (width, height, fx, fy, ppx, ppy) of a pyrealsense2 intrinsics object, a dict or a sequence
+    if isinstance(intrinsics, dict):
+        values = [intrinsics[f] for f in INTRINSICS_FIELDS]
+    elif hasattr(intrinsics, 'fx'):
+        values = [getattr(intrinsics, f) for f in INTRINSICS_FIELDS]
+    else:
+        values = list(intrinsics)
+    return (int(values[0]), int(values[1])) + tuple(float(v) for v in values[2:])
+
+
+class AngleTables:
+    # Tangents of the per-column and per-row viewing angles of a stream, indexed by pixel edge (0..width,
+    # 0..height) so box (x1, y1, x2, y2) spans col_tan[x1]..col_tan[x2]. They are the normalized image plane
+    # coordinates, the lateral extent of a box at depth z is z * (col_tan[x2] - col_tan[x1])
+
+    def __init__(self, width, height, fx, fy, ppx, ppy):
+        self.width, self.height = width, height
+        self.col_tan = (np.arange(width + 1) - ppx) / fx
+        self.row_tan = (np.arange(height + 1) - ppy) / fy
+
+    def extents(self, boxes):
+        # (N, 2) tangent extents (width, height) of (x1, y1, x2, y2) boxes, clipped to the frame
+        boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        x = np.clip(boxes[:, 0::2], 0, self.width)
+        y = np.clip(boxes[:, 1::2], 0, self.height)
+        return np.abs(np.stack([self.col_tan[x[:, 1]] - self.col_tan[x[:, 0]],
+                                self.row_tan[y[:, 1]] - self.row_tan[y[:, 0]]], axis=1))
+
+
+@functools.lru_cache(maxsize=8)
+def _angle_tables(key):
+    return AngleTables(*key)
+
+
+def angle_tables(intrinsics=None, shape=None):
+    # Angle tables for a stream profile, built once per distinct set of intrinsics. Without intrinsics the
+    # FOV_PER_PIX calibration is used for a frame of the given (height, width) shape
+    if intrinsics is None:
+        intrinsics = default_intrinsics(shape[1], shape[0])
+    return _angle_tables(intrinsics_key(intrinsics))
+
+
+def decimated_intrinsics(intrinsics, magnitude):
+    # Intrinsics key of a stream decimated by magnitude: every output pixel is an m x m block whose
+    # center is input pixel m * x + (m - 1) / 2
+    width, height, fx, fy, ppx, ppy = intrinsics_key(intrinsics)
+    m = float(magnitude)
+    return (width // magnitude, height // magnitude, fx / m, fy / m, (ppx + 0.5) / m - 0.5, (ppy + 0.5) / m - 0.5)
+
+
+class RayTable:
+    # Per-pixel rays (x / z, y / z, 1) of a stream, what rs.rs2_deproject_pixel_to_point computes for every
+    # pixel of an undistorted stream (the depth stream's model). The point at pixel (x, y) is z * rays[y, x]
+
+    def __init__(self, width, height, fx, fy, ppx, ppy):
+        self.width, self.height = width, height
+        self.fx, self.fy, self.ppx, self.ppy = fx, fy, ppx, ppy
+        self.rays = np.empty((height, width, 3), dtype=np.float32)
+        self.rays[:, :, 0] = (np.arange(width) - ppx) / fx
+        self.rays[:, :, 1] = ((np.arange(height) - ppy) / fy)[:, None]
+        self.rays[:, :, 2] = 1
+        self._scaled = {}
+        self._texcoords = None
+
+    def scaled(self, depth_scale=DEPTH_SCALE):
+        # Rays times depth_scale, so z16 depth units multiply straight into meters
+        rays = self._scaled.get(depth_scale)
+        if rays is None:
+            rays = self._scaled[depth_scale] = self.rays * np.float32(depth_scale)
+        return rays
+
+    def deproject(self, depth, depth_scale=DEPTH_SCALE, out=None):
+        # (height, width, 3) float32 points in meters of a z16 depth frame, written into out when it has the
+        # right shape (pass the previous result to reuse it). Invalid (0) depth gives (0, 0, 0) like rs.pointcloud
+        if depth.shape != (self.height, self.width):
+            raise ValueError('depth frame is %dx%d, the ray table %dx%d' % (
+                depth.shape[1], depth.shape[0], self.width, self.height))
+        if out is None or out.shape != self.rays.shape or out.dtype != np.float32:
+            out = np.empty(self.rays.shape, dtype=np.float32)
+        return np.multiply(self.scaled(depth_scale), depth[:, :, None], out=out)
+
+    def deproject_pixels(self, pixels, depth, depth_scale=DEPTH_SCALE):
+        # (N, 3) points of integer (x, y) pixels, with their depth read from the z16 depth frame
+        x, y = np.asarray(pixels, dtype=np.int64).reshape(-1, 2).T
+        return self.scaled(depth_scale)[y, x] * depth[y, x, None]
+
+    @property
+    def texcoords(self):
+        # (height * width, 2) texture coordinates of a color image aligned to this stream, like
+        # rs.points.get_texture_coordinates() after pc.map_to(aligned color)
+        if self._texcoords is None:
+            u = np.arange(self.width, dtype=np.float32) / self.width
+            v = np.arange(self.height, dtype=np.float32) / self.height
+            self._texcoords = np.stack(np.broadcast_arrays(u[None, :], v[:, None]), axis=-1).reshape(-1, 2)
+        return self._texcoords
+
+
+def deproject_points(intrinsics, pixels, z):
+    # (N, 3) points of (x, y) pixels, subpixel allowed, at depths z in meters. Needs no ray table, so none is
+    # built. The NumPy path is the pinhole model; rs.intrinsics with a distortion model and non-zero coeffs
+    # (e.g. the Inverse Brown-Conrady color stream of D4xx cameras) go through rs.rs2_deproject_pixel_to_point,
+    # which undistorts the pixels first
+    pixels = np.asarray(pixels, dtype=np.float64).reshape(-1, 2)
+    z = np.asarray(z, dtype=np.float64).reshape(-1)
+    coeffs = getattr(intrinsics, 'coeffs', None)
+    if coeffs is not None and any(coeffs):
+        import pyrealsense2 as rs
+        if intrinsics.model != rs.distortion.none:
+            return np.array([rs.rs2_deproject_pixel_to_point(intrinsics, [float(x), float(y)], float(d))
+                             for (x, y), d in zip(pixels, z)], dtype=np.float64).reshape(-1, 3)
+    _, _, fx, fy, ppx, ppy = intrinsics_key(intrinsics)
+    return np.stack([(pixels[:, 0] - ppx) / fx * z, (pixels[:, 1] - ppy) / fy * z, z], axis=1)
+
+
+@functools.lru_cache(maxsize=8)
+def _ray_table(key):
+    return RayTable(*key)
+
+
+def ray_table(intrinsics=None, shape=None, decimate=1):
+    # Ray table for a stream profile, built once per distinct set of intrinsics and decimation magnitude.
+    # Without intrinsics the FOV_PER_PIX calibration is used for a frame of the given (height, width) shape
+    if intrinsics is None:
+        intrinsics = default_intrinsics(shape[1], shape[0])
+    key = intrinsics_key(intrinsics) if decimate == 1 else decimated_intrinsics(intrinsics, decimate)
+    return _ray_table(key)
+
+
+def depth_from_box_array(depth, boxes, reference=0, intrinsics=None, depth_scale=DEPTH_SCALE, profile=None):
+    # Depths for N boxes around objects of the same size. The reference box (the closest one by default)
+    # turns its RealSense depth into a physical size, every box's depth is then estimated from its extent in
+    # the intrinsics' angle tables. Sizes are (width, height) columns and everything is an array over boxes
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    pixel_size = np.abs(np.stack([boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]], axis=1))
+    with _stage(profile, 'depth_median', (len(boxes),)):
+        median, valid_fraction = box_medians(depth, boxes)
+    realsense_depth = median * depth_scale
+
+    # Image plane extents of every box, a plane at depth z sees z * extent meters
+    extent = angle_tables(intrinsics, depth.shape).extents(boxes)
+    physical_size = realsense_depth[reference] * extent[reference]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        size_depth = physical_size / extent
+    estimated_depth = size_depth.mean(axis=1)
+
+    logger.debug('pixel sizes (w, h) %s', pixel_size.tolist())
+    logger.debug('realsense depths %s, valid pixel fractions %s', realsense_depth.tolist(), valid_fraction.tolist())
+    logger.debug('reference physical size (w, h) %s', physical_size.tolist())
+    logger.debug('depths from size (w, h) %s, average %s', size_depth.tolist(), estimated_depth.tolist())
+
+    return {'realsense_depth': realsense_depth, 'valid_fraction': valid_fraction, 'pixel_size': pixel_size,
+            'physical_size': physical_size, 'size_depth': size_depth, 'estimated_depth': estimated_depth}
+
+
+def depth_from_boxes(depth, boxes, intrinsics=None, profile=None):
+    # Assume first box is always closest box, returns (estimated depth, RealSense depth) per box
+    if len(boxes) == 0:
+        return []
+    out = depth_from_box_array(depth, boxes_to_array(boxes), intrinsics=intrinsics, profile=profile)
+    computed_depths = [(None, out['realsense_depth'][0])]
+    computed_depths += list(zip(out['estimated_depth'][1:], out['realsense_depth'][1:]))
+    return computed_depths
+
+
+def lorde_from_roi(roi_coords, bgr_frame, depth, edge_cache=None, intrinsics=None, profile=None, frame_id=None):
+    # profile=True (or a StageProfile to accumulate into) adds per-stage timings to the result under 'profile'.
+    # With an edge_cache, several ROIs on the same frame share its mask and edges when they pass the same
+    # frame_id (e.g. the capture index or timestamp), without one every call rebuilds them. profile=False is off
+    profile = StageProfile() if profile is True else (profile or None)
+    with _stage(profile, 'lorde_from_roi', bgr_frame.shape):
+        out = _lorde_from_roi(roi_coords, bgr_frame, depth, edge_cache, intrinsics, profile, frame_id)
+    if profile is not None:
+        out['profile'] = profile
+    return out
+
+
+def _lorde_from_roi(roi_coords, bgr_frame, depth, edge_cache=None, intrinsics=None, profile=None, frame_id=None):
     x1, y1, x2, y2 = roi_coords
-    img = color_selection_mask(bgr_frame, [0, 255, 255])
+    # Reuse the mask and edge pyramid only when the caller says the cache was built for this frame, object
+    # identity is not enough since a caller may write every new frame into the same buffer
+    if edge_cache is not None and frame_id is not None and edge_cache.frame_id == frame_id:
+        img = edge_cache.image
+    else:
+        img = color_selection_mask(bgr_frame, [0, 255, 255], profile=profile)
+        if edge_cache is not None:
+            edge_cache.reset(img, frame_id)
     ref_img = img[y1:y2, x1:x2]
-    matched_boxes, scales = find_matching_boxes(img, ref_img)
-    computed_depths = depth_from_boxes(depth, matched_boxes)
+    with _stage(profile, 'find_matching_boxes', img.shape):
+        matched_boxes, scales = find_matching_boxes(img, ref_img, edge_cache=edge_cache, profile=profile)
+    with _stage(profile, 'depth_from_boxes', depth.shape):
+        computed_depths = depth_from_boxes(depth, matched_boxes, intrinsics, profile)
     return {'matched_boxes': matched_boxes, 'computed_depths': computed_depths}
 
 
-
+class LordeTracker:
+    # lorde_from_roi on a video: the first frame runs the full search for the ROI's template, later frames
+    # only track the matched boxes (see BoxTracker) and recompute their depths. With temporal=k the RealSense
+    # depths come from the per-pixel median of the last k depth frames instead of the current one
+
+    MIN_ROI_SIZE = 8  # pixels, smaller templates have no edges to match
+
+    def __init__(self, roi_coords, bgr_frame, intrinsics=None, temporal=None, **tracker_args):
+        x1, y1, x2, y2 = roi_coords
+        if min(x2 - x1, y2 - y1) < self.MIN_ROI_SIZE:
+            raise ValueError('ROI %s is smaller than %d pixels' % (tuple(roi_coords), self.MIN_ROI_SIZE))
+        img = color_selection_mask(bgr_frame, [0, 255, 255])
+        self.tracker = BoxTracker(img[y1:y2, x1:x2], **tracker_args)
+        self.intrinsics = intrinsics
+        self.accumulator = DepthAccumulator(temporal) if temporal else None
+        self._mask = None
+
+    def update(self, bgr_frame, depth, profile=None):
+        # {'matched_boxes', 'computed_depths'} for this frame, like lorde_from_roi
+        self._mask = color_selection_mask(bgr_frame, [0, 255, 255], out=self._mask, profile=profile)
+        matched_boxes, _ = self.tracker.update(self._mask, profile=profile)
+        if self.accumulator is not None:
+            self.accumulator.update(depth)
+            if matched_boxes:
+                with _stage(profile, 'temporal_median', depth.shape):
+                    # Only the region around the boxes is needed, the median of the whole frame is far slower
+                    boxes = boxes_to_array(matched_boxes)
+                    region = np.concatenate([boxes[:, :2].min(axis=0), boxes[:, 2:].max(axis=0)])
+                    depth = self.accumulator.median(region)
+        with _stage(profile, 'depth_from_boxes', depth.shape):
+            computed_depths = depth_from_boxes(depth, matched_boxes, self.intrinsics, profile)
+        return {'matched_boxes': matched_boxes, 'computed_depths': computed_depths}